@@ -0,0 +1,79 @@
+'''
+比较cudf（GPU）与cpu（pandas）两种计算引擎构建三种共现矩阵的耗时，并检查输出是否一致
+
+用法（在项目根目录下）：
+    python -m benchmarks.engine_benchmark --sessions 60000 --aids 100000 --files 12
+'''
+import argparse, os, tempfile, time
+import pandas as pd
+
+from src.engine import has_cudf
+from src.file_manager import FileManager
+from src.co_visitation_matrix import CoVisitationMatrix
+from utils.synthetic import write_dataset
+
+MATRICES = ('carts_orders', 'buy_2_buy', 'clicks')
+OUTPUTS = {'carts_orders': 'top_15_carts_orders', 'buy_2_buy': 'top_15_buy2buy', 'clicks': 'top_20_clicks'}
+
+
+def run_engine(root, engine, output_dir, disk_pieces):
+    fm = FileManager(root, engine=engine)
+    start = time.perf_counter()
+    fm.read()
+    timings = {'read': time.perf_counter() - start}
+    cvm = CoVisitationMatrix(fm, output_dir=output_dir)
+    for name in MATRICES:
+        start = time.perf_counter()
+        getattr(cvm, name)(disk_pieces=disk_pieces)
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def load_output(output_dir, name, disk_pieces):
+    df = pd.concat([pd.read_parquet(f'{output_dir}/{OUTPUTS[name]}_{p}.pqt') for p in range(disk_pieces)])
+    return df.sort_values(['aid_x', 'aid_y']).reset_index(drop=True)
+
+
+# 以 (aid_x, aid_y) 为键比较两个引擎的输出，权重允许float32的误差；并列权重可能导致第K名不同，单独统计
+def compare(a, b):
+    merged = a.merge(b, on=['aid_x', 'aid_y'], how='outer', suffixes=('_a', '_b'), indicator=True)
+    both = merged.loc[merged._merge == 'both']
+    wgt_diff = float((both.wgt_a - both.wgt_b).abs().max()) if len(both) else 0.0
+    return {'rows': len(a), 'only_one_side': int((merged._merge != 'both').sum()), 'max_wgt_diff': wgt_diff}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=None, help='已有数据集目录，不指定时生成合成数据')
+    parser.add_argument('--sessions', type=int, default=60_000)
+    parser.add_argument('--aids', type=int, default=100_000)
+    parser.add_argument('--files', type=int, default=12)
+    parser.add_argument('--disk-pieces', type=int, default=2)
+    parser.add_argument('--engines', nargs='+', choices=['cudf', 'cpu'],
+                        default=['cudf', 'cpu'] if has_cudf() else ['cpu'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root or write_dataset(f'{tmp}/parquet', n_sessions=args.sessions, n_aids=args.aids,
+                                          n_files=args.files)
+        results = {}
+        for engine in args.engines:
+            output_dir = f'{tmp}/{engine}'
+            os.makedirs(output_dir, exist_ok=True)
+            print(f'\n===== engine: {engine} =====')
+            results[engine] = run_engine(root, engine, output_dir, args.disk_pieces)
+
+        print('\n耗时（秒）：')
+        print(pd.DataFrame(results).round(3).to_string())
+
+        if len(args.engines) > 1:
+            base = args.engines[0]
+            for engine in args.engines[1:]:
+                for name in MATRICES:
+                    diff = compare(load_output(f'{tmp}/{base}', name, args.disk_pieces),
+                                   load_output(f'{tmp}/{engine}', name, args.disk_pieces))
+                    print(f'{base} vs {engine} {name}: {diff}')
+
+
+if __name__ == '__main__':
+    main()
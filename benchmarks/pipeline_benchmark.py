@@ -0,0 +1,220 @@
+'''
+整条流水线的基准测试：在可复现的合成数据上依次计时 FileManager 读取与预处理、各种共现矩阵构建方式、load_metrix、
+HandCraftedRules.train 与 save，统计吞吐（事件/秒）、延迟（每个session的推理耗时分布）与内存峰值，
+并检查不同构建方式、不同引擎、不同规则实现的输出是否一致；没有cudf时以原有实现的pandas版本（merge(on='session') 生成商品对、
+sort_values + cumcount 截断与取前k个）作为比较的基准，cpu引擎的各种构建方式都与它比较
+
+数据规模由 --scale 决定（scale=1 为 20000 个训练session、50000 个商品），相同的 --scale 与 --seed 生成相同的数据
+
+用法（在项目根目录下）：
+    python -m benchmarks.pipeline_benchmark --scale 1
+    python -m benchmarks.pipeline_benchmark --scale 5 --workers 4 --apply --output ./bench.json
+'''
+import argparse, glob, json, os, tempfile, time
+import pandas as pd
+
+from benchmarks.engine_benchmark import compare
+from src.co_visitation_matrix import CoVisitationMatrix
+from src.engine import has_cudf
+from src.file_manager import FileManager
+from src.handcrafted_rules import HandCraftedRules
+from src.matrix_spec import DEFAULT_SPECS, N_AIDS
+from utils.profiler import peak_rss_mb, profiler
+from utils.synthetic import write_dataset
+
+
+class Timer:
+    '''
+     记录每一步的耗时、吞吐与结束时的内存峰值（进程级的最高水位，只增不减）
+    '''
+
+    def __init__(self):
+        self.rows = []
+
+    def run(self, label, step, events, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.rows.append({'engine': label, 'step': step, 'seconds': seconds,
+                          'events_per_s': events / seconds if events and seconds else None,
+                          'peak_rss_mb': peak_rss_mb()})
+        print(f'[{label}] {step}: {seconds:.3f}s')
+        return result
+
+
+def count_events(root):
+    return sum(len(pd.read_parquet(f, columns=['session'])) for f in glob.glob(f'{root}/*_parquet/*'))
+
+
+def load_outputs(output_dir, specs):
+    return {spec.name: pd.concat([pd.read_parquet(f'{output_dir}/{spec.prefix}_{p}.pqt') for p in range(spec.pieces)])
+            .sort_values(['aid_x', 'aid_y']).reset_index(drop=True) for spec in specs}
+
+
+# 原有实现的CPU参考：按原来的文件分组（6个CHUNK，每组READ_CT个文件）逐组用 merge(on='session') 生成商品对、
+# drop_duplicates 去重并求和，最后 sort_values + cumcount 取前k个；不使用 window_pairs、reverse_ts_runs 与 top_k_per_group
+# 商品对的权重和与分片无关，所以每种矩阵只扫描一次，再按aid_x的范围写出各个分片
+def reference_build(fm, specs, output_dir):
+    for spec in specs:
+        tmp = None
+        for j in range(6):
+            begin, end = j * fm.CHUNK, min((j + 1) * fm.CHUNK, fm.files_len)
+            tmp2 = None
+            for k in range(begin, end, fm.READ_CT):
+                df = pd.concat([fm.read_file(f) for f in fm.files[k:min(k + fm.READ_CT, end)]], ignore_index=True)
+                if spec.types is not None:
+                    df = df.loc[df['type'].isin(spec.types)]
+                df = df.sort_values(['session', 'ts'], ascending=[True, False]).reset_index(drop=True)
+                df['n'] = df.groupby('session').cumcount()
+                df = df.loc[df.n < spec.last_n].drop('n', axis=1)
+                df = df.merge(df, on='session')
+                df = df.loc[((df.ts_x - df.ts_y).abs() < spec.window) & (df.aid_x != df.aid_y)]
+                if spec.pair_filter is not None:
+                    df = df.loc[spec.pair_filter(df)]
+                df = df.drop_duplicates(['session', 'aid_x', 'aid_y'])
+                df = df.assign(wgt=spec.weight(df))[['aid_x', 'aid_y', 'wgt']].astype({'wgt': 'float32'})
+                df = df.groupby(['aid_x', 'aid_y']).wgt.sum()
+                tmp2 = df if tmp2 is None else tmp2.add(df, fill_value=0)
+            if tmp2 is not None:
+                tmp = tmp2 if tmp is None else tmp.add(tmp2, fill_value=0)
+        tmp = tmp.reset_index().sort_values(['aid_x', 'wgt'], ascending=[True, False]).reset_index(drop=True)
+        tmp['n'] = tmp.groupby('aid_x').aid_y.cumcount()
+        tmp = tmp.loc[tmp.n < spec.top_k].drop('n', axis=1)
+        size = N_AIDS / spec.pieces
+        for piece in range(spec.pieces):
+            part = tmp.loc[(tmp.aid_x >= piece * size) & (tmp.aid_x < (piece + 1) * size)]
+            part.reset_index(drop=True).to_parquet(f'{output_dir}/{spec.prefix}_{piece}.pqt')
+
+
+# 与基准（原有实现的输出）比较其他构建方式的输出
+def check_builders(base, outputs, specs):
+    checks = []
+    reference = load_outputs(base, specs)
+    for name, output_dir in outputs.items():
+        other = load_outputs(output_dir, specs)
+        for spec in specs:
+            diff = compare(reference[spec.name], other[spec.name])
+            diff.update(build=name, matrix=spec.name,
+                        identical=bool(reference[spec.name].equals(other[spec.name])))
+            checks.append(diff)
+    return checks
+
+
+def run_engine(engine, root, tmp, specs, timer, events, workers, apply):
+    fm = FileManager(root, engine=engine)
+    timer.run(engine, 'FileManager.read', events, fm.read)
+    store = FileManager(root, engine=engine, store_dir=f'{tmp}/{engine}/event_store')
+    timer.run(engine, 'FileManager.preprocess', events, store.preprocess)
+    timer.run(engine, 'FileManager.read (store)', events, store.read)
+
+    # 逐片构建（原有的方式）对每种矩阵单独计时，写入同一个目录
+    outputs = {f'{engine} train_by_piece': f'{tmp}/{engine}/train_by_piece'}
+    os.makedirs(outputs[f'{engine} train_by_piece'], exist_ok=True)
+    cvm = CoVisitationMatrix(fm, output_dir=outputs[f'{engine} train_by_piece'], specs=specs)
+    for spec in specs:
+        timer.run(engine, f'train_by_piece ({spec.name})', events, cvm.train_by_piece, [spec])
+
+    builds = [('train_fused', fm, lambda cvm: cvm.train_fused(specs)),
+              ('train_fused (spill)', fm, lambda cvm: cvm.train_fused(specs, spill_dir=f'{tmp}/{engine}/spill')),
+              ('train_fused (store)', store, lambda cvm: cvm.train_fused(specs))]
+    if not fm.engine.is_gpu and workers > 1:
+        builds.append(('train_parallel', fm, lambda cvm: cvm.train_parallel(workers, specs)))
+    for name, manager, build in builds:
+        output_dir = f'{tmp}/{engine}/{name.replace(" (", "_").rstrip(")")}'
+        os.makedirs(output_dir, exist_ok=True)
+        timer.run(engine, name, events, build, CoVisitationMatrix(manager, output_dir=output_dir, specs=specs))
+        outputs[f'{engine} {name}'] = output_dir
+
+    cvm = CoVisitationMatrix(fm, output_dir=outputs[f'{engine} train_fused'], specs=specs)
+    timer.run(engine, 'export_csr', 0, cvm.export_csr)
+    timer.run(engine, 'load_metrix', 0, cvm.load_metrix)
+    test_events = len(cvm.test_df)
+
+    rules = HandCraftedRules()
+    timer.run(engine, 'HandCraftedRules.train', test_events, rules.train, cvm, workers=workers)
+    predictions = {'batch': (rules.pred_df_clicks, rules.pred_df_buys)}
+    if apply:
+        slow = HandCraftedRules()
+        timer.run(engine, 'HandCraftedRules.train (apply)', test_events, slow.train, cvm, engine='apply')
+        predictions['apply'] = (slow.pred_df_clicks, slow.pred_df_buys)
+
+    # save() 写入当前目录下的 submission.csv
+    cwd = os.getcwd()
+    os.chdir(f'{tmp}/{engine}')
+    try:
+        timer.run(engine, 'HandCraftedRules.save', test_events, rules.save)
+    finally:
+        os.chdir(cwd)
+    return outputs, predictions
+
+
+def same_predictions(a, b):
+    return all(x.index.equals(y.index) and x.tolist() == y.tolist() for x, y in zip(a, b))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0, help='数据规模倍数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--length-dist', choices=['geometric', 'lognormal'], default='lognormal',
+                        help='session长度的分布')
+    parser.add_argument('--pieces', type=int, default=4, help='每种矩阵的分片数（逐片构建时的扫描次数）')
+    parser.add_argument('--workers', type=int, default=1, help='并行构建与并行执行规则的进程数')
+    parser.add_argument('--apply', action='store_true', help='同时计时逐session执行规则，并与批量结果比较')
+    parser.add_argument('--engines', nargs='+', choices=['cudf', 'cpu'],
+                        default=['cudf', 'cpu'] if has_cudf() else ['cpu'])
+    parser.add_argument('--output', default=None, help='结果保存路径（.json）')
+    args = parser.parse_args()
+
+    specs = [spec.with_pieces(args.pieces) for spec in DEFAULT_SPECS]
+    params = {'sessions': int(20_000 * args.scale), 'aids': int(50_000 * args.scale),
+              'test_sessions': int(3_000 * args.scale)}
+    profiler.enable()
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        root = write_dataset(f'{tmp}/parquet', n_sessions=params['sessions'], n_aids=params['aids'], n_files=12,
+                             test_sessions=params['test_sessions'], test_files=6, seed=args.seed,
+                             length_dist=args.length_dist)
+        events = count_events(root)
+        print(f'Generated {events} events in {time.perf_counter() - start:.1f}s: {params}')
+
+        timer, outputs, predictions = Timer(), {}, {}
+        # 有cudf时原有的GPU逐片构建就是原有实现，作为基准；否则先运行原有实现的pandas版本
+        if 'cudf' in args.engines:
+            base_dir = None
+        else:
+            base_dir = f'{tmp}/reference'
+            os.makedirs(base_dir, exist_ok=True)
+            timer.run('cpu', 'reference (pandas merge)', events, reference_build, FileManager(root, engine='cpu'),
+                      specs, base_dir)
+        for engine in args.engines:
+            out, pred = run_engine(engine, root, tmp, specs, timer, events, args.workers, args.apply)
+            outputs.update(out)
+            predictions.update({f'{engine} {name}': p for name, p in pred.items()})
+
+        checks = check_builders(base_dir or outputs['cudf train_by_piece'], outputs, specs)
+        base = f'{args.engines[0]} batch'
+        rule_checks = {name: same_predictions(predictions[base], p) for name, p in predictions.items() if name != base}
+
+    print('\n耗时与吞吐：')
+    print(pd.DataFrame(timer.rows).round(3).to_string(index=False))
+    print('\n阶段统计：')
+    summary = profiler.summary()
+    columns = ['stage', 'calls', 'seconds', 'rows_in', 'rows_out', 'rows_out_per_in', 'bytes_read', 'peak_rss_mb']
+    print(pd.DataFrame(summary['stages'])[columns].round(3).to_string(index=False))
+    for name, h in summary['histograms'].items():
+        print(f'{name}: {h["count"]} sessions, p50 {h["p50"]:.3f}ms, p99 {h["p99"]:.3f}ms, max {h["max"]:.3f}ms')
+    print(f'\n输出一致性（与{"原有实现的pandas版本" if "cudf" not in args.engines else "cudf的逐片构建"}比较）：')
+    print(pd.DataFrame(checks).to_string(index=False))
+    for name, same in rule_checks.items():
+        print(f'rules {base} vs {name}: {"identical" if same else "DIFFERENT"}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'params': params, 'events': events, 'steps': timer.rows,
+                       'profile': summary, 'checks': checks, 'rule_checks': rule_checks}, f, indent=1)
+        print(f'Results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+在线推荐服务的压测：先在进程内直接调用 RecommendationService.recommend，再通过HTTP前端并发请求，
+统计p50/p99延迟与吞吐，并与 src/service.py 中的延迟目标比较
+
+用法（在项目根目录下）：
+    python -m benchmarks.service_load_test                               # 生成合成数据、构建共现矩阵后压测
+    python -m benchmarks.service_load_test --root ./parquet --output-dir ./handled_files
+    python -m benchmarks.service_load_test --url 127.0.0.1:8080 --root ./parquet --output-dir ./handled_files
+'''
+import argparse, asyncio, json, os, tempfile, threading, time
+import numpy as np
+
+from src.co_visitation_matrix import CoVisitationMatrix
+from src.file_manager import FileManager
+from src.service import P50_TARGET_MS, P99_TARGET_MS, RecommendationService, start_server
+from utils.synthetic import write_dataset
+
+
+# 延迟目标只针对进程内调用；HTTP压测的延迟包含网络与并发排队，只做记录
+def summary(name, seconds, wall, check=False):
+    ms = np.array(seconds) * 1000
+    p50, p99 = np.percentile(ms, 50), np.percentile(ms, 99)
+    line = f'{name}: {len(ms)} requests, {len(ms) / wall:.0f} req/s, p50 {p50:.3f}ms, p99 {p99:.3f}ms, max {ms.max():.3f}ms'
+    if check:
+        line += (f'  (target p50 <= {P50_TARGET_MS}ms: {"OK" if p50 <= P50_TARGET_MS else "MISS"}, '
+                 f'p99 <= {P99_TARGET_MS}ms: {"OK" if p99 <= P99_TARGET_MS else "MISS"})')
+    print(line)
+
+
+# 从测试集中抽取session，转换为请求中的事件列表
+def sample_requests(test_df, n, seed=0):
+    groups = test_df.groupby('session')
+    sessions = np.random.default_rng(seed).choice(list(groups.groups), n)
+    cache = {}
+    for s in sessions:
+        if s not in cache:
+            g = groups.get_group(s)
+            cache[s] = [[int(a), int(t), int(y)] for a, t, y in zip(g.aid, g.ts, g['type'])]
+        yield cache[s]
+
+
+def in_process(service, requests):
+    latencies = []
+    start = time.perf_counter()
+    for events in requests:
+        t = time.perf_counter()
+        service.recommend(events)
+        latencies.append(time.perf_counter() - t)
+    summary('in-process', latencies, time.perf_counter() - start, check=True)
+
+
+async def _client(host, port, requests, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    for events in requests:
+        body = json.dumps({'events': events}).encode()
+        t = time.perf_counter()
+        writer.write(f'POST /recommend HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        await reader.readline()
+        length = 0
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            if line.lower().startswith(b'content-length'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - t)
+    writer.close()
+
+
+async def over_http(host, port, requests, concurrency):
+    latencies = []
+    shards = [requests[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(host, port, shard, latencies) for shard in shards))
+    summary(f'http x{concurrency}', latencies, time.perf_counter() - start)
+
+
+# 在后台线程中启动HTTP前端，返回端口
+def start_background(service):
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        async def main():
+            server = await start_server(service, port=0)
+            state['port'] = server.sockets[0].getsockname()[1]
+            ready.set()
+            await server.serve_forever()
+
+        asyncio.run(main())
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return state['port']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=None, help='原始数据目录，不指定时生成合成数据并构建共现矩阵')
+    parser.add_argument('--output-dir', default=None, help='共现矩阵目录')
+    parser.add_argument('--url', default=None, help='已运行的服务 host:port，不指定时在本进程内启动')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.root is None:
+            args.root = write_dataset(f'{tmp}/parquet', n_sessions=20_000, n_aids=20_000, n_files=6)
+            args.output_dir = f'{tmp}/handled_files'
+            os.makedirs(args.output_dir)
+            fm = FileManager(args.root, engine='cpu')
+            fm.read()
+            CoVisitationMatrix(fm, output_dir=args.output_dir).train()
+        cvm = CoVisitationMatrix(FileManager(args.root, engine='cpu'), output_dir=args.output_dir or './handled_files')
+        cvm.load_metrix()
+
+        requests = list(sample_requests(cvm.test_df, args.requests))
+        service = RecommendationService(cvm)
+        in_process(service, requests)
+
+        if args.url:
+            host, port = args.url.rsplit(':', 1)
+        else:
+            host, port = '127.0.0.1', start_background(service)
+        asyncio.run(over_http(host, int(port), requests, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
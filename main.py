@@ -3,34 +3,48 @@ Title : 使用手工规则的重排候选模型
 '''
 
 import numpy as np
-import cudf, gc
+import gc, os
 from src.file_manager import FileManager
 from src.co_visitation_matrix import CoVisitationMatrix
 from src.handcrafted_rules import HandCraftedRules
+from utils.profiler import profiler
 from utils.show_pred import show_pred
 
 VER = 1  # 版本号
-print(f'Version {VER}\nRAPIDS version {cudf.__version__}')
+ENGINE = 'auto'  # 计算引擎：'cudf'（GPU）、'cpu'（pandas）或 'auto'（有cudf时使用GPU）
+LAZY_CACHE_BYTES = None  # 设置后按需读取文件，缓存上限（字节）；None表示预先加载全部文件
+WORKERS = 1  # 并行进程数（cpu引擎下构建共现矩阵、按session分片执行规则）
+SPILL_DIR = None  # 单次扫描构建共现矩阵时分片结果的溢写目录；cudf引擎下为None时逐片计算（显存占用最小）
+STORE_DIR = './event_store'  # 规范化事件存储目录；None表示每次直接读取原始parquet
+RESUME = True  # 共现矩阵训练从运行清单继续，跳过已完成的分片
+PRED_PATH = './submission_pred'  # 预测的定长数组（npy目录或.parquet），供show_pred按session查找；None表示只写CSV
+METRICS_PATH = None  # 设置后记录各阶段的统计，运行结束时导出（.json 或 .csv）
 if __name__ == '__main__':
-    file_manager = FileManager()
+    if METRICS_PATH is not None: profiler.enable()
+    file_manager = FileManager(engine=ENGINE, lazy=LAZY_CACHE_BYTES is not None, cache_bytes=LAZY_CACHE_BYTES,
+                               store_dir=STORE_DIR)
+    print(f'Version {VER}\nEngine {file_manager.engine.version}')
     co_visitation_matrix = CoVisitationMatrix(file_manager)
     handcrafted_rules = HandCraftedRules()
 
-    # # 读取文件、预处理
+    # # 读取文件、预处理（规范化存储只在第一次运行时构建）
+    # if STORE_DIR is not None: file_manager.preprocess()
     # file_manager.read()
     # print(
     #     f'We will process {file_manager.files_len} files, in groups of {file_manager.READ_CT} and chunks of {file_manager.CHUNK}.')
     #
     # # 特征工程、计算共现矩阵（Co-visitation Matrix）
-    # co_visitation_matrix.train()
+    # co_visitation_matrix.train(spill_dir=SPILL_DIR, workers=WORKERS, resume=RESUME)
     #
     # file_manager.clear_cache()
     # gc.collect()
 
     # # 使用共现矩阵预测
     # co_visitation_matrix.load_metrix()
-    # handcrafted_rules.train(co_visitation_matrix)
-    # handcrafted_rules.save()
+    # handcrafted_rules.train(co_visitation_matrix, workers=WORKERS)
+    # handcrafted_rules.save(array_path=PRED_PATH)
 
     # 展示数据
-    show_pred()
+    show_pred(PRED_PATH) if PRED_PATH is not None and os.path.exists(PRED_PATH) else show_pred()
+
+    if METRICS_PATH is not None: profiler.export(METRICS_PATH)
@@ -0,0 +1,182 @@
+import numpy as np, pandas as pd
+
+from src.candidates import BUYS_COUNT
+from src.csr_store import CSRMatrix
+from src.top_k import group_bounds, top_k_per_group
+
+'''
+手工规则的批量向量化实现：所有session一次性计算，结果与 HandCraftedRules.suggest_clicks / suggest_buys 逐条一致
+数据以扁平数组表示（按session、ts排序的事件 + 每个session的起始位置），(session, aid) 组合编码为一个int64键，
+Counter 的累加用 np.bincount（按数组顺序逐个相加，浮点结果与逐条累加相同），
+most_common 的并列顺序（先插入者在前）用每个键第一次出现的位置表示，再交给 top_k_per_group 做分组前20
+'''
+
+SHIFT = 32  # (session序号 << 32) | aid
+
+
+def _key(s, aid):
+    return (s.astype('int64') << SHIFT) | aid.astype('int64')
+
+
+def _split_key(key):
+    return key >> SHIFT, key & ((1 << SHIFT) - 1)
+
+
+def _as_csr(matrix):
+    return matrix if isinstance(matrix, CSRMatrix) else CSRMatrix.from_dict(matrix)
+
+
+# 按query顺序展开CSR中每个aid的邻居（邻居保持原顺序），返回 (query行号, 邻居aid)
+def _gather(csr, aids):
+    return csr.gather(aids)[:2]
+
+
+# 每个session去重后的aid，最近的在前（等价于 list(dict.fromkeys(aids[::-1]))），返回 (session序号, aid)
+def _recent_unique(s, aid):
+    if len(s) == 0:
+        return s, aid
+    key = _key(s, aid)[::-1]
+    _, first = np.unique(key, return_index=True)
+    pos = len(key) - 1 - first  # 每个(session, aid)最后一次出现的位置
+    pos = pos[np.lexsort((-pos, s[pos]))]
+    return s[pos], aid[pos]
+
+
+# 对 (session, aid, 权重) 条目做 Counter 式累加，取每个session得分最高的k个；并列时先出现的在前
+def _counter_top(s, aid, wgt, k):
+    uniq, first, inv = np.unique(_key(s, aid), return_index=True, return_inverse=True)
+    score = np.bincount(inv.ravel(), weights=wgt, minlength=len(uniq))
+    us, ua = _split_key(uniq)
+    order = np.lexsort((first, us))
+    order = order[top_k_per_group(us[order], score[order], k)]
+    return us[order], ua[order]
+
+
+# 每个session内的序号（0, 1, 2, ...），s需已按session排列
+def _rank(s):
+    starts, counts = group_bounds(s)
+    return np.arange(len(s)) - np.repeat(starts, counts)
+
+
+class BatchRules:
+    '''
+     cvm的共现矩阵可以是CSRMatrix或dict（dict会先转换为CSR）；购买预测只转换buy_scorer用到的矩阵
+     buy_scorer 为 suggest_buys 合并候选的方式（见candidates.py），默认与原规则相同
+    '''
+
+    def __init__(self, cvm, type_weight_multipliers, buy_scorer=BUYS_COUNT):
+        self.top_20_clicks = _as_csr(cvm.top_20_clicks)
+        self.top_clicks = np.asarray(list(cvm.top_clicks), dtype='int64')
+        self.top_orders = np.asarray(list(cvm.top_orders), dtype='int64')
+        self.multipliers = np.array([type_weight_multipliers[t] for t in range(3)], dtype='float64')
+        self.buy_scorer = buy_scorer
+        self.matrices = {attr: _as_csr(getattr(cvm, attr)) for attr in buy_scorer.attrs}
+
+    # 按session、ts排序后转换为扁平数组
+    def _events(self, test_df):
+        df = test_df.sort_values(['session', 'ts'])
+        sessions = df.session.values
+        starts, counts = group_bounds(sessions)
+        s = np.repeat(np.arange(len(starts)), counts)
+        return sessions[starts], starts, counts, s, df.aid.values.astype('int64'), df['type'].values
+
+    # 与 np.logspace(low, 1, n, base=2) - 1 逐个session计算的结果相同
+    @staticmethod
+    def _recency_weights(s, starts, counts, low):
+        n = counts[s]
+        i = np.arange(len(s)) - starts[s]
+        step = np.subtract(1.0, low) / np.maximum(n - 1, 1)
+        y = i * step + low
+        y[i == n - 1] = 1.0
+        return np.power(2.0, y) - 1
+
+    # 历史商品足够多（去重后>=20）的session：按时间、类型加权排序，extra为额外加分的 (session, aid, 权重)
+    def _weighted(self, ev, low, sel, extra=None):
+        sessions, starts, counts, s, aid, types = ev
+        w = self._recency_weights(s, starts, counts, low) * self.multipliers[types]
+        m = sel[s]
+        s, aid, w = s[m], aid[m], w[m]
+        if extra is not None:
+            s, aid, w = np.r_[s, extra[0]], np.r_[aid, extra[1]], np.r_[w, extra[2]]
+        return _counter_top(s, aid, w, 20)
+
+    # 历史商品较少的session：历史商品（最近的在前）+ 共现矩阵候选（按出现次数，排除历史商品）+ 热门商品补足
+    @staticmethod
+    def _with_candidates(u_s, u_aid, n_unique, cand_s, cand_aid, top, cand_w=None):
+        cs, ca = _counter_top(cand_s, cand_aid, np.ones(len(cand_s)) if cand_w is None else cand_w, 20)
+        keep = ~np.isin(_key(cs, ca), _key(u_s, u_aid))
+        cs, ca = cs[keep], ca[keep]
+        keep = _rank(cs) < 20 - n_unique[cs]
+        cs, ca = cs[keep], ca[keep]
+
+        # 用热门商品补足20个（与原规则一致，不去重）
+        n_fill = np.minimum(np.maximum(20 - n_unique - np.bincount(cs, minlength=len(n_unique)), 0), len(top))
+        sel = np.unique(u_s)
+        fs = np.repeat(sel, n_fill[sel])
+        fa = top[_rank(fs)] if len(fs) else fs
+
+        # 三部分按 (session, 部分, 部分内序号) 拼接
+        s = np.r_[u_s, cs, fs]
+        a = np.r_[u_aid, ca, fa]
+        part = np.repeat([0, 1, 2], [len(u_s), len(cs), len(fs)])
+        rank = np.r_[_rank(u_s), _rank(cs), _rank(fs)]
+        order = np.lexsort((rank, part, s))
+        return s[order], a[order]
+
+    # 各来源对 queries（{'all'/'buys': (session序号, aid)}）中商品的邻居，拼接为 (session序号, 邻居aid, 得分)
+    def _source_scores(self, sources, queries):
+        parts = [(np.empty(0, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0))]
+        for src in sources:
+            qs, qa = queries[src.query]
+            q, neighbours, score = src.scores(self.matrices[src.attr], qa)
+            parts.append((qs[q], neighbours, score))
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    @staticmethod
+    def _to_series(sessions, s, aid):
+        bounds = np.r_[0, np.cumsum(np.bincount(s, minlength=len(sessions)))]
+        aid = aid.tolist()
+        values = [aid[bounds[i]:bounds[i + 1]] for i in range(len(sessions))]
+        return pd.Series(values, index=pd.Index(sessions, name='session'))
+
+    @staticmethod
+    def _merge(*parts):
+        s = np.concatenate([p[0] for p in parts])
+        a = np.concatenate([p[1] for p in parts])
+        order = np.argsort(s, kind='stable')
+        return s[order], a[order]
+
+    def suggest_clicks(self, test_df):
+        ev = self._events(test_df)
+        sessions, s, aid = ev[0], ev[3], ev[4]
+        u_s, u_aid = _recent_unique(s, aid)
+        n_unique = np.bincount(u_s, minlength=len(sessions))
+        many = n_unique >= 20
+
+        weighted = self._weighted(ev, 0.1, many)
+        m = ~many[u_s]
+        u_s, u_aid = u_s[m], u_aid[m]
+        q, nb = _gather(self.top_20_clicks, u_aid)
+        few = self._with_candidates(u_s, u_aid, n_unique, u_s[q], nb, self.top_clicks)
+        return self._to_series(sessions, *self._merge(weighted, few))
+
+    def suggest_buys(self, test_df):
+        ev = self._events(test_df)
+        sessions, s, aid, types = ev[0], ev[3], ev[4], ev[5]
+        u_s, u_aid = _recent_unique(s, aid)
+        n_unique = np.bincount(u_s, minlength=len(sessions))
+        many = n_unique >= 20
+        buy = (types == 1) | (types == 2)
+        b_s, b_aid = _recent_unique(s[buy], aid[buy])
+
+        # 历史商品多的session：在历史商品得分之上加 boost 来源的邻居得分（原规则为buy2buy邻居每个加0.1分）
+        m, mb = many[u_s], many[b_s]
+        extra = self._source_scores(self.buy_scorer.boost, {'all': (u_s[m], u_aid[m]), 'buys': (b_s[mb], b_aid[mb])})
+        weighted = self._weighted(ev, 0.5, many, extra)
+
+        m, mb = ~many[u_s], ~many[b_s]
+        u_s, u_aid, b_s, b_aid = u_s[m], u_aid[m], b_s[mb], b_aid[mb]
+        queries = {'all': (u_s, u_aid), 'buys': (b_s, b_aid)}
+        cand_s, cand_aid, cand_w = self._source_scores(self.buy_scorer.sources, queries)
+        few = self._with_candidates(u_s, u_aid, n_unique, cand_s, cand_aid, self.top_orders, cand_w)
+        return self._to_series(sessions, *self._merge(weighted, few))
@@ -0,0 +1,109 @@
+import heapq
+from operator import itemgetter
+import numpy as np
+
+'''
+候选商品的打分与合并：从多个共现矩阵（CSRMatrix）取出查询商品的邻居，把矩阵中保存的权重乘以各矩阵的系数后累加，
+按得分取前k个；并列时先出现者在前，与 Counter.most_common 的顺序相同
+逐session时直接把各行邻居的得分累加到一个dict，再用 heapq.nlargest 取前k个，不需要先拼接邻居列表再交给Counter；
+批量时由 BatchRules 对所有session一起向量化计算（见batch_rules.py），两者的结果相同
+'''
+
+
+class Source:
+    '''
+     attr       CoVisitationMatrix 上共现矩阵的属性名
+     coef       邻居得分的系数
+     query      'all'：用session去重后的全部历史商品查询邻居；'buys'：只用加购物车/购买过的商品
+     weighted   True 时邻居的得分为矩阵中保存的权重，False 时每个邻居计1分（即原规则中 Counter 的计数）
+     normalize  weighted=True 时把权重除以该行最大的权重（每行的第一个邻居），使不同矩阵的得分处于同一量级
+     weighted=True 时矩阵须保存了权重：由dict（load_metrix(fmt='dict')）转换的矩阵没有权重，会抛出 ValueError
+    '''
+
+    def __init__(self, attr, coef=1.0, query='all', weighted=True, normalize=True):
+        self.attr = attr
+        self.coef = coef
+        self.query = query
+        self.weighted = weighted
+        self.normalize = normalize
+
+    # 没有权重的矩阵按权重打分时，所有权重都为1，结果会与计数相同，直接报错而不是静默地退化
+    def _check(self, csr):
+        if self.weighted and not csr.weighted:
+            raise ValueError(f'{self.attr} 没有保存权重（由dict转换），不能用于 weighted=True 的 {self!r}；'
+                             f"请使用 load_metrix(fmt='csr') 加载共现矩阵")
+
+    # 批量：展开aids的邻居，返回 (aids中的序号, 邻居aid, 得分)
+    def scores(self, csr, aids):
+        self._check(csr)
+        q, neighbours, weights = csr.gather(aids)
+        if not self.weighted:
+            return q, neighbours, np.full(len(q), float(self.coef))
+        scale = self.coef
+        if self.normalize and len(q):
+            scale = self.coef / csr.weights[csr.indptr[aids[q]]].astype('float64')
+        return q, neighbours, scale * weights.astype('float64')
+
+    # 逐session：把query中商品的邻居得分累加到scores（dict的插入顺序即第一次出现的顺序）
+    def accumulate(self, csr, query, scores):
+        self._check(csr)
+        indptr, indices, weights, n_rows = csr.indptr, csr.indices, csr.weights, csr.n_rows
+        get, coef = scores.get, self.coef
+        for aid in query:
+            if not 0 <= aid < n_rows:
+                continue
+            begin, end = indptr[aid:aid + 2].tolist()
+            if begin == end:
+                continue
+            if not self.weighted:
+                for neighbour in indices[begin:end].tolist():
+                    scores[neighbour] = get(neighbour, 0) + coef
+                continue
+            row = weights[begin:end].tolist()
+            scale = coef / row[0] if self.normalize else coef
+            for neighbour, weight in zip(indices[begin:end].tolist(), row):
+                scores[neighbour] = get(neighbour, 0) + scale * weight
+
+    def __repr__(self):
+        return (f'Source({self.attr!r}, coef={self.coef}, query={self.query!r}, weighted={self.weighted}, '
+                f'normalize={self.normalize})')
+
+
+class CandidateScorer:
+    '''
+     sources  历史商品较少的session合并的候选来源，按顺序累加（决定并列时的先后）
+     boost    历史商品较多的session在按时间、类型加权的历史商品得分之上额外加分的来源
+    '''
+
+    def __init__(self, sources, boost=()):
+        self.sources = tuple(sources)
+        self.boost = tuple(boost)
+
+    @property
+    def attrs(self):
+        return tuple(dict.fromkeys(src.attr for src in self.sources + self.boost))
+
+    # 一个session：matrices 为 {属性名: CSRMatrix}，queries 为 {'all': 历史商品, 'buys': 加购物车/购买商品}
+    # （均已去重、最近的在前），base 为预先计算的 (aid列表, 得分列表)，先于各来源累加
+    @staticmethod
+    def top(matrices, sources, queries, k=20, base=None):
+        scores = {}
+        if base is not None:
+            for aid, score in zip(*base):
+                scores[aid] = scores.get(aid, 0) + score
+        for src in sources:
+            src.accumulate(matrices[src.attr], queries[src.query], scores)
+        return [aid for aid, score in heapq.nlargest(k, scores.items(), key=itemgetter(1))]
+
+    def __repr__(self):
+        return f'CandidateScorer(sources={list(self.sources)}, boost={list(self.boost)})'
+
+
+# 原规则：历史商品少时 buys 与 buy2buy 的邻居各计1次，历史商品多时 buy2buy 的邻居各加0.1分
+BUYS_COUNT = CandidateScorer([Source('top_20_buys', 1, 'all', weighted=False),
+                              Source('top_20_buy2buy', 1, 'buys', weighted=False)],
+                             boost=[Source('top_20_buy2buy', 0.1, 'buys', weighted=False)])
+
+# 使用矩阵中保存的权重（每行按最大权重归一化），系数与原规则的计数量级相同
+BUYS_WEIGHTED = CandidateScorer([Source('top_20_buys', 1.0, 'all'), Source('top_20_buy2buy', 1.0, 'buys')],
+                                boost=[Source('top_20_buy2buy', 0.1, 'buys')])
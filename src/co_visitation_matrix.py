@@ -1,17 +1,38 @@
-import gc, cudf
-import pandas as pd
+import argparse, gc, multiprocessing, os
+import numpy as np, pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 from src.file_manager import FileManager
+from src.piece_accumulator import PieceAccumulator, SpillAccumulator, TreeAccumulator
+from src.csr_store import CSRMatrix
+from src.event_store import reverse_ts_runs
+from src.matrix_spec import BUY2BUY, CARTS_ORDERS, CLICKS, DEFAULT_SPECS, N_AIDS
+from src.pair_kernel import PairColumns, window_pairs
+from src.run_manifest import RunManifest, fingerprint_files
+from src.top_k import top_k_per_group
+from utils.profiler import profiler, staged
 
 '''
 构建三种共现矩阵，用于反映用户的兴趣热点与三种特征的关系，从而更好地理解用户行为模式
+单独计算部分矩阵或分片（例如分给多台机器，输出目录共享）：
+    python -m src.co_visitation_matrix --matrix clicks --piece 16 17 18 19
 '''
 
 
+_WORKER_STATE = None  # 并行模式下由主进程设置为 (CoVisitationMatrix, specs)，fork后的工作进程直接使用
+
+
+# 工作进程的统计从空开始（fork时复制了主进程的统计），随结果一起返回给主进程合并
+def _group_task(files):
+    cvm, specs = _WORKER_STATE
+    profiler.reset()
+    return cvm._group_weights(files, specs), profiler.drain()
+
+
 class CoVisitationMatrix:
-    DISK_PIECES_CARTS_ORDERS = 20
-    DISK_PIECES_BUY2BUY = 4
-    DISK_PIECES_CLICKS = 20
+    DISK_PIECES_CARTS_ORDERS = CARTS_ORDERS.pieces
+    DISK_PIECES_BUY2BUY = BUY2BUY.pieces
+    DISK_PIECES_CLICKS = CLICKS.pieces
 
     top_20_buys = None
     top_20_buy2buy = None
@@ -22,273 +43,343 @@ class CoVisitationMatrix:
 
     test_df = None
 
-    def __init__(self, file_manager: FileManager, output_dir="./handled_files"):
+    def __init__(self, file_manager: FileManager, output_dir="./handled_files", specs=DEFAULT_SPECS):
         self.fm = file_manager
         self.output_dir = output_dir
+        self.engine = file_manager.engine  # 计算引擎与FileManager保持一致，cpu引擎下使用pandas完成同样的向量化计算
+        self.xd = self.engine.xd
+        self.specs = tuple(specs)  # 需要构建的共现矩阵（见matrix_spec.py）
+        self._manifest = None
 
     # 关注商品之间的共现关系（对三种行为分配不同权重，时间限度为1天）
     def carts_orders(self, disk_pieces=DISK_PIECES_CARTS_ORDERS):
-        type_weight = {0: 1, 1: 6, 2: 3}
-        # disk_pieces为对商品id的分片，意味着每次对这一范围内的，disk_pieces过小可能会导致爆显存
-        # 注意最外层的分片是为了在循环末尾筛选该商品id范围内的商品，属于是逻辑分片
-        size = 1.86e6 / disk_pieces  # 按照商品数划分，每一片有多少商品数
-        # 按商品划分的片，逐片对数据进行处理
-        for piece in range(disk_pieces):
-            print('\n### DISK PART', piece + 1)
-
-            # => OUTER CHUNKS
-            # 第二层循环是物理分片，每次20个文件
-            # 注意CHUNK和READ_CT的关系，READ_CT是为了减少爆显存风险，单次计算的文件数，CHUNK被分为了多个READ_CT小分片
-            # 每次对计算完的所有READ_CT进行汇总到tmp2，再对所有CHUNK计算结果汇总到tmp
-            tmp, tmp2, df = None, None, None
-            for j in range(6):
-                begin = j * self.fm.CHUNK
-                end = min((j + 1) * self.fm.CHUNK, self.fm.files_len)
-                print(f'Processing files {begin} ~ {end - 1} in groups of {self.fm.READ_CT}...')
-
-                # => INNER CHUNKS
-                # 第三、四层循环是进一步分片，每次对一个CHUNK读取READ_CT个文件再计算
-                for k in range(begin, end, self.fm.READ_CT):
-                    # 读取READ_CT个文件
-                    df = [self.fm.read_file(self.fm.files[k])]
-                    for i in range(1, self.fm.READ_CT):
-                        if k + i < end: df.append(self.fm.read_file(self.fm.files[k + i]))
-                    # 根据session ts排序
-                    df = cudf.concat(df, ignore_index=True, axis=0)
-                    df = df.sort_values(['session', 'ts'], ascending=[True, False])
-
-                    # 对于每个session 只取30条（cumcount是累积计数）
-                    df = df.reset_index(drop=True)
-                    df['n'] = df.groupby('session').cumcount()
-                    df = df.loc[df.n < 30].drop('n', axis=1)
-
-                    # 以下都是关键操作
-                    # 进行内联操作（共现分析的关键），通过对session进行内联，并且筛选出时间差在24小时以内、商品种类不同的一对操作
-                    # 可以视为同一用户强相关的一对操作，这对后续预测非常关键
-                    df = df.merge(df, on='session')
-                    df = df.loc[((df.ts_x - df.ts_y).abs() < 24 * 60 * 60) & (df.aid_x != df.aid_y)]
-
-                    # 根据商品id进行逻辑分片
-                    df = df.loc[(df.aid_x >= piece * size) & (df.aid_x < (piece + 1) * size)]
-
-                    # 计算商品对的最终权重分布，越大说明关联性越强
-                    df = df[['session', 'aid_x', 'aid_y', 'type_y']].drop_duplicates(
-                        ['session', 'aid_x', 'aid_y'])  # 去重
-                    df['wgt'] = df.type_y.map(type_weight)  # 根据类型分配权重
-                    df = df[['aid_x', 'aid_y', 'wgt']]  # 保留主要属性
-                    df.wgt = df.wgt.astype('float32')
-                    df = df.groupby(['aid_x', 'aid_y']).wgt.sum()  # 对相同商品对求和，计算总权重
-
-                    # 结合INNER CHUNKS计算结果
-                    if k == begin:
-                        tmp2 = df
-                    else:
-                        tmp2 = tmp2.add(df, fill_value=0)
-                    print(k, ', ', end='')
-                print()
-                # 结合OUTER CHUNKS计算结果
-                if begin == 0:
-                    tmp = tmp2
-                else:
-                    tmp = tmp.add(tmp2, fill_value=0)
-                del tmp2, df
-                gc.collect()
-            # 根据 商品id 和 权重 排序
-            tmp = tmp.reset_index()
-            tmp = tmp.sort_values(['aid_x', 'wgt'], ascending=[True, False])
-            # 只需要前15个
-            tmp = tmp.reset_index(drop=True)
-            tmp['n'] = tmp.groupby('aid_x').aid_y.cumcount()
-            tmp = tmp.loc[tmp.n < 15].drop('n', axis=1)
-            # 保存结果
-            tmp.to_pandas().to_parquet(f'{self.output_dir}/top_15_carts_orders_{piece}.pqt')
-            del tmp
-        return self
+        return self.train_by_piece([CARTS_ORDERS.with_pieces(disk_pieces)])
 
     # 关注购买行为的共现关系（它只关注加购物车和购买两种行为，并且时间限度为14天）
     def buy_2_buy(self, disk_pieces=DISK_PIECES_BUY2BUY):
-        # disk_pieces为对商品id的分片，意味着每次对这一范围内的，disk_pieces过小可能会导致爆显存
-        # 注意最外层的分片是为了在循环末尾筛选该商品id范围内的商品，属于是逻辑分片
-        size = 1.86e6 / disk_pieces  # 按照商品数划分，每一片有多少商品数
-        # 按商品划分的片，逐片对数据进行处理
-        for piece in range(disk_pieces):
-            print('\n### DISK PART', piece + 1)
-
-            # => OUTER CHUNKS
-            # 第二层循环是物理分片，每次20个文件
-            # 注意CHUNK和READ_CT的关系，READ_CT是为了减少爆显存风险，单次计算的文件数，CHUNK被分为了多个READ_CT小分片
-            # 每次对计算完的所有READ_CT进行汇总到tmp2，再对所有CHUNK计算结果汇总到tmp
-            tmp, tmp2, df = None, None, None
-            for j in range(6):
-                begin = j * self.fm.CHUNK
-                end = min((j + 1) * self.fm.CHUNK, self.fm.files_len)
-                print(f'Processing files {begin} ~ {end - 1} in groups of {self.fm.READ_CT}...')
-
-                # => INNER CHUNKS
-                # 第三、四层循环是进一步分片，每次对一个CHUNK读取READ_CT个文件再计算
-                for k in range(begin, end, self.fm.READ_CT):
-                    # 读取READ_CT个文件
-                    df = [self.fm.read_file(self.fm.files[k])]
-                    for i in range(1, self.fm.READ_CT):
-                        if k + i < end: df.append(self.fm.read_file(self.fm.files[k + i]))
-                    # 根据session ts排序
-                    df = cudf.concat(df, ignore_index=True, axis=0)
-                    df = df.loc[df['type'].isin([1, 2])]  # ONLY WANT CARTS AND ORDERS
-                    df = df.sort_values(['session', 'ts'], ascending=[True, False])
-
-                    # 对于每个session 只取30条（cumcount是累积计数）
-                    df = df.reset_index(drop=True)
-                    df['n'] = df.groupby('session').cumcount()
-                    df = df.loc[df.n < 30].drop('n', axis=1)
-
-                    # 以下都是关键操作
-                    # 进行内联操作（共现分析的关键），通过对session进行内联，并且筛选出时间差在14天以内、商品种类不同的一对操作
-                    # 可以视为同一用户强相关的一对操作，这对后续预测非常关键
-                    df = df.merge(df, on='session')
-                    df = df.loc[((df.ts_x - df.ts_y).abs() < 14 * 24 * 60 * 60) & (df.aid_x != df.aid_y)]  # 14 DAYS
-
-                    # 根据商品id进行逻辑分片
-                    df = df.loc[(df.aid_x >= piece * size) & (df.aid_x < (piece + 1) * size)]
-
-                    # 计算商品对的最终权重分布，越大说明关联性越强
-                    df = df[['session', 'aid_x', 'aid_y', 'type_y']].drop_duplicates(
-                        ['session', 'aid_x', 'aid_y'])  # 去重
-                    df['wgt'] = 1  # 权重定为1
-                    df = df[['aid_x', 'aid_y', 'wgt']]  # 保留主要属性
-                    df.wgt = df.wgt.astype('float32')
-                    df = df.groupby(['aid_x', 'aid_y']).wgt.sum()  # 对相同商品对求和，计算总权重
-
-                    # 结合INNER CHUNKS计算结果
-                    if k == begin:
-                        tmp2 = df
-                    else:
-                        tmp2 = tmp2.add(df, fill_value=0)
-                    print(k, ', ', end='')
-                print()
-                # 结合OUTER CHUNKS计算结果
-                if begin == 0:
-                    tmp = tmp2
-                else:
-                    tmp = tmp.add(tmp2, fill_value=0)
-                del tmp2, df
-                gc.collect()
-            # 根据 商品id 和 权重 排序
-            tmp = tmp.reset_index()
-            tmp = tmp.sort_values(['aid_x', 'wgt'], ascending=[True, False])
-            # 只需要前15个
-            tmp = tmp.reset_index(drop=True)
-            tmp['n'] = tmp.groupby('aid_x').aid_y.cumcount()
-            tmp = tmp.loc[tmp.n < 15].drop('n', axis=1)
-            # 保存结果
-            tmp.to_pandas().to_parquet(f'{self.output_dir}/top_15_buy2buy_{piece}.pqt')
-            del tmp
-        return self
+        return self.train_by_piece([BUY2BUY.with_pieces(disk_pieces)])
 
     # 关注用户浏览行为的共现关系（它分配的权重为时间，所以体现出用户浏览的即时兴趣和趋势，时间限度为1天）
     def clicks(self, disk_pieces=DISK_PIECES_CLICKS):
-        # disk_pieces为对商品id的分片，意味着每次对这一范围内的，disk_pieces过小可能会导致爆显存
-        # 注意最外层的分片是为了在循环末尾筛选该商品id范围内的商品，属于是逻辑分片
-        size = 1.86e6 / disk_pieces  # 按照商品数划分，每一片有多少商品数
-        # 按商品划分的片，逐片对数据进行处理
-        for piece in range(disk_pieces):
-            print('\n### DISK PART', piece + 1)
-
-            # => OUTER CHUNKS
-            # 第二层循环是物理分片，每次20个文件
-            # 注意CHUNK和READ_CT的关系，READ_CT是为了减少爆显存风险，单次计算的文件数，CHUNK被分为了多个READ_CT小分片
-            # 每次对计算完的所有READ_CT进行汇总到tmp2，再对所有CHUNK计算结果汇总到tmp
-            tmp, tmp2, df = None, None, None
-            for j in range(6):
-                begin = j * self.fm.CHUNK
-                end = min((j + 1) * self.fm.CHUNK, self.fm.files_len)
-                print(f'Processing files {begin} ~ {end - 1} in groups of {self.fm.READ_CT}...')
-
-                # => INNER CHUNKS
-                # 第三、四层循环是进一步分片，每次对一个CHUNK读取READ_CT个文件再计算
-                for k in range(begin, end, self.fm.READ_CT):
-                    # 读取READ_CT个文件
-                    df = [self.fm.read_file(self.fm.files[k])]
-                    for i in range(1, self.fm.READ_CT):
-                        if k + i < end: df.append(self.fm.read_file(self.fm.files[k + i]))
-                    # 根据session ts排序
-                    df = cudf.concat(df, ignore_index=True, axis=0)
-                    df = df.sort_values(['session', 'ts'], ascending=[True, False])
-
-                    # 对于每个session 只取30条（cumcount是累积计数）
-                    df = df.reset_index(drop=True)
-                    df['n'] = df.groupby('session').cumcount()
-                    df = df.loc[df.n < 30].drop('n', axis=1)
-
-                    # 以下都是关键操作
-                    # 进行内联操作（共现分析的关键），通过对session进行内联，并且筛选出时间差在24小时以内、商品种类不同的一对操作
-                    # 可以视为同一用户强相关的一对操作，这对后续预测非常关键
-                    df = df.merge(df, on='session')
-                    df = df.loc[((df.ts_x - df.ts_y).abs() < 24 * 60 * 60) & (df.aid_x != df.aid_y)]
-
-                    # 根据商品id进行逻辑分片
-                    df = df.loc[(df.aid_x >= piece * size) & (df.aid_x < (piece + 1) * size)]
-
-                    # 计算商品对的最终权重分布，越大说明关联性越强
-                    df = df[['session', 'aid_x', 'aid_y', 'ts_x']].drop_duplicates(['session', 'aid_x', 'aid_y'])
-                    df['wgt'] = 1 + 3 * (df.ts_x - 1659304800) / (1662328791 - 1659304800)
-                    df = df[['aid_x', 'aid_y', 'wgt']]  # 保留主要属性
-                    df.wgt = df.wgt.astype('float32')
-                    df = df.groupby(['aid_x', 'aid_y']).wgt.sum()  # 对相同商品对求和，计算总权重
-
-                    # 结合INNER CHUNKS计算结果
-                    if k == begin:
-                        tmp2 = df
-                    else:
-                        tmp2 = tmp2.add(df, fill_value=0)
-                    print(k, ', ', end='')
-                print()
-                # 结合OUTER CHUNKS计算结果
-                if begin == 0:
-                    tmp = tmp2
-                else:
-                    tmp = tmp.add(tmp2, fill_value=0)
-                del tmp2, df
-                gc.collect()
-            # 根据 商品id 和 权重 排序
-            tmp = tmp.reset_index()
+        return self.train_by_piece([CLICKS.with_pieces(disk_pieces)])
+
+    # 规范化存储中的文件各自已排序，按第一个session的顺序拼接后整组仍按 (session, ts) 有序
+    def _read_group(self, files):
+        if self.fm.presorted:
+            files = sorted(files, key=self.fm.first_session)
+        return self.xd.concat([self.fm.read_file(f) for f in files], ignore_index=True, axis=0)
+
+    # 根据session ts排序，每个session只取最近的n条；CPU上已排序的数据只需把ts倒序，不需要重新排序
+    def _last_n(self, df, n=30):
+        session = df.session.values
+        if self.fm.presorted and not self.engine.is_gpu and (session[1:] >= session[:-1]).all():
+            df = df.iloc[reverse_ts_runs(session, df.ts.values)]
+        else:
+            df = df.sort_values(['session', 'ts'], ascending=[True, False])
+        df = df.reset_index(drop=True)
+        df['n'] = df.groupby('session').cumcount()
+        return df.loc[df.n < n].drop('n', axis=1)
+
+    # session内时间差在window秒以内、商品种类不同（且满足pair_filter）的一对操作，按 (session, aid_x, aid_y) 去重保留第一对
+    # cpu引擎下由 pair_kernel 直接生成窗口内的商品对，不做内联；输入需为 _last_n 的输出（session升序、ts降序）
+    def _pairs(self, df, window, pair_filter=None):
+        columns = ['aid_x', 'aid_y', 'ts_x', 'ts_y', 'type_x', 'type_y']
+        if self.engine.is_gpu:
+            df = df.merge(df, on='session')
+            mask = ((df.ts_x - df.ts_y).abs() < window) & (df.aid_x != df.aid_y)
+            if pair_filter is not None: mask &= pair_filter(df)
+            return df.loc[mask].drop_duplicates(['session', 'aid_x', 'aid_y'])[columns]
+        pair_mask = None if pair_filter is None else lambda x, y: pair_filter(PairColumns(df, x, y))
+        x, y = window_pairs(df.session.values, df.aid.values, df.ts.values, window, pair_mask)
+        pairs = PairColumns(df, x, y)
+        return pd.DataFrame({col: pairs[col] for col in columns})
+
+    # 按aid_x逻辑分片，返回 {piece: 该片内各商品对的权重和}；指定piece时只计算这一片
+    # 全部分片时只做一次groupby：结果按aid_x有序，各分片为其中连续的一段，用二分查找得到分界后切片，
+    # 耗时与分片数基本无关（每组商品对的求和与逐片过滤后求和相同）
+    @staticmethod
+    def _sum_by_piece(df, disk_pieces, only=None):
+        size = N_AIDS / disk_pieces
+        if only is not None:
+            part = df.loc[(df.aid_x >= only * size) & (df.aid_x < (only + 1) * size)]
+            return {only: part.groupby(['aid_x', 'aid_y']).wgt.sum()}
+        sums = df.groupby(['aid_x', 'aid_y'], sort=True).wgt.sum()
+        # 第piece片为 piece * size <= aid_x < (piece + 1) * size，aid_x为整数，分界取上整
+        bounds = np.ceil(np.arange(disk_pieces + 1) * size).astype('int64')
+        cuts = sums.index.get_level_values('aid_x').searchsorted(bounds).tolist()
+        return {piece: sums.iloc[cuts[piece]:cuts[piece + 1]] for piece in range(disk_pieces)}
+
+    # 每个aid_x只保留权重最高的top_k个商品并保存
+    # cpu引擎下使用按组部分选择（见top_k.py），不对全部商品对做完整排序；结果与排序+cumcount一致
+    def _save_top(self, tmp, top_k, name, piece):
+        with profiler.stage('top_k') as stage:
+            stage.rows_in = len(tmp)
+            tmp = self._top(tmp, top_k)
+            stage.rows_out = len(tmp)
+        self.engine.to_pandas(tmp).to_parquet(f'{self.output_dir}/top_{top_k}_{name}_{piece}.pqt')
+
+    def _top(self, tmp, top_k):
+        tmp = tmp.reset_index()
+        if self.engine.is_gpu:
             tmp = tmp.sort_values(['aid_x', 'wgt'], ascending=[True, False])
-            # 只需要前20个
             tmp = tmp.reset_index(drop=True)
             tmp['n'] = tmp.groupby('aid_x').aid_y.cumcount()
-            tmp = tmp.loc[tmp.n < 20].drop('n', axis=1)
-            # 保存结果
-            tmp.to_pandas().to_parquet(f'{self.output_dir}/top_20_clicks_{piece}.pqt')
-            del tmp
+            tmp = tmp.loc[tmp.n < top_k].drop('n', axis=1)
+        else:
+            aid_x = tmp.aid_x.values
+            if len(aid_x) and (aid_x[1:] < aid_x[:-1]).any():
+                tmp = tmp.iloc[np.argsort(aid_x, kind='stable')]
+            tmp = tmp.iloc[top_k_per_group(tmp.aid_x.values, tmp.wgt.values, top_k)].reset_index(drop=True)
+        return tmp
+
+    # 计算一组文件对各矩阵的贡献，返回 {矩阵名: {分片号: 商品对权重和}}；指定piece时每种矩阵只计算这一片
+    # 文件组只读取一次；过滤条件和截断相同的矩阵共用事件，窗口和商品对过滤也相同的矩阵共用商品对
+    def _group_weights(self, files, specs, piece=None):
+        with profiler.stage('read_group') as stage:
+            df = self._read_group(files)
+            stage.rows_out = len(df)
+        result, events = {}, {}
+        groups = {}
+        for spec in specs: groups.setdefault(spec.pair_key, []).append(spec)
+
+        for same in groups.values():
+            spec = same[0]
+            if spec.scan_key not in events:
+                with profiler.stage('last_n') as stage:
+                    part = df if spec.types is None else df.loc[df['type'].isin(list(spec.types))]
+                    events[spec.scan_key] = self._last_n(part, spec.last_n)
+                    stage.rows_in, stage.rows_out = len(df), len(events[spec.scan_key])
+            # rows_out / rows_in 为商品对的膨胀倍数
+            with profiler.stage('pairs') as stage:
+                pairs = self._pairs(events[spec.scan_key], spec.window, spec.pair_filter)
+                stage.rows_in, stage.rows_out = len(events[spec.scan_key]), len(pairs)
+            for spec in same:
+                with profiler.stage('weights') as stage:
+                    wgt = pairs[['aid_x', 'aid_y']].copy()
+                    wgt['wgt'] = spec.weight(pairs)
+                    wgt.wgt = wgt.wgt.astype('float32')
+                    result[spec.name] = self._sum_by_piece(wgt, spec.pieces, piece)
+                    stage.rows_in, stage.rows_out = len(wgt), sum(len(p) for p in result[spec.name].values())
+            del pairs, wgt
+        return result
+
+    # 所有文件组，按CHUNK划分：[(CHUNK号, 起始文件k, 该组的READ_CT个文件), ...]
+    def _groups(self):
+        groups = []
+        for j in range(6):
+            begin = j * self.fm.CHUNK
+            end = min((j + 1) * self.fm.CHUNK, self.fm.files_len)
+            groups.extend((j, k, self.fm.files[k:min(k + self.fm.READ_CT, end)])
+                          for k in range(begin, end, self.fm.READ_CT))
+        return groups
+
+    # 扫描全部文件组，把各矩阵的分片权重累加到acc（{矩阵名: 累加器}）中
+    def _scan(self, specs, acc, piece=None):
+        chunk = 0
+        groups = self._groups()
+        for i, (j, k, files) in enumerate(groups):
+            if i + 1 < len(groups): self.fm.prefetch(groups[i + 1][2])  # 后台预读下一组文件
+            if j != chunk:
+                print()
+                for name in acc: acc[name].end_chunk()
+                gc.collect()
+                chunk = j
+            for name, parts in self._group_weights(files, specs, piece).items():
+                acc[name].add(parts)
+            print(k, ', ', end='')
+        print()
+        for name in acc: acc[name].end_chunk()
+
+    # 运行清单（见run_manifest.py），输入文件的指纹在第一次使用时计算
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = RunManifest(f'{self.output_dir}/manifest', fingerprint_files(self.fm.files))
+        return self._manifest
+
+    def _output(self, spec, piece):
+        return f'{self.output_dir}/{spec.prefix}_{piece}.pqt'
+
+    # 尚未完成的分片；resume=False 时为全部分片；pieces中超出该矩阵分片数的分片号不属于这个矩阵，直接忽略
+    def _pending(self, spec, resume, pieces=None):
+        pieces = range(spec.pieces) if pieces is None else [p for p in pieces if 0 <= p < spec.pieces]
+        return [p for p in pieces if not (resume and self.manifest.is_done(spec, p, self._output(spec, p)))]
+
+    # 保存累加完成的分片，每保存一个分片就在运行清单中标记完成；pending为 {矩阵名: 需要保存的分片}
+    def _save_all(self, acc, specs, pending=None):
+        for spec in specs:
+            for piece in acc[spec.name].pieces():
+                tmp = acc[spec.name].pop(piece)
+                if pending is not None and piece not in pending[spec.name]:
+                    continue
+                self._save_top(tmp, spec.top_k, spec.name, piece)
+                self.manifest.mark_done(spec, piece, self._output(spec, piece), len(tmp))
+
+    # 单次扫描同时构建全部共现矩阵：每组文件只读取、排序、生成商品对一次，各矩阵的权重同时计算，并按aid_x分片累加
+    # 与逐个矩阵逐片计算相比，扫描次数从 20+4+20 次减少为 1 次
+    # spill_dir为空时所有分片的累加结果都保存在内存中（内存占用约为完整矩阵大小）；
+    # 指定spill_dir时每组文件的分片结果溢写到磁盘，最后逐片归约，内存占用只与单个分片有关
+    # resume=True 时跳过运行清单中已完成的分片，全部完成的矩阵不参与扫描
+    def train_fused(self, specs=None, spill_dir=None, resume=False):
+        specs = self.specs if specs is None else specs
+        pending = {spec.name: self._pending(spec, resume) for spec in specs}
+        specs = [spec for spec in specs if pending[spec.name]]
+        if not specs:
+            print('All pieces are already done.')
+            return self
+        if spill_dir is None:
+            acc = {spec.name: PieceAccumulator() for spec in specs}
+        else:
+            acc = {spec.name: SpillAccumulator(f'{spill_dir}/{spec.name}', self.engine) for spec in specs}
+        self._scan(specs, acc)
+        self._save_all(acc, specs, pending)
         return self
 
-    def train(self):
-        self.carts_orders().buy_2_buy().clicks()
+    # 逐个矩阵、逐个分片扫描全部文件（原有的计算方式）：每次只计算一个分片，显存占用最小，但扫描次数为各矩阵分片数之和
+    # pieces指定只计算其中的部分分片（可以分给多台机器或多个进程分别计算）；resume=True 时跳过已完成的分片
+    def train_by_piece(self, specs=None, pieces=None, resume=False):
+        for spec in self.specs if specs is None else specs:
+            for piece in self._pending(spec, resume, pieces):
+                print(f'\n### {spec.name} DISK PART', piece + 1)
+                acc = {spec.name: PieceAccumulator()}
+                self._scan([spec], acc, piece)
+                self._save_all(acc, [spec])
         return self
 
-    def load_metrix(self):
-        self.top_20_buys = self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/top_15_carts_orders_0.pqt'))
-        for k in range(1, self.DISK_PIECES_CARTS_ORDERS):
-            self.top_20_buys.update(
-                self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/top_15_carts_orders_{k}.pqt'))
-            )
-
-        self.top_20_buy2buy = self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/top_15_buy2buy_0.pqt'))
-        for k in range(1, self.DISK_PIECES_BUY2BUY):
-            self.top_20_buy2buy.update(
-                self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/top_15_buy2buy_{k}.pqt'))
-            )
-
-        self.top_20_clicks = self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/top_20_clicks_0.pqt'))
-        for k in range(1, self.DISK_PIECES_CLICKS):
-            self.top_20_clicks.update(
-                self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/top_20_clicks_{k}.pqt'))
-            )
+    # 多进程并行构建：每个工作进程计算一组文件的分片权重，主进程按到达顺序做树形归并（见TreeAccumulator）
+    # 工作进程通过fork继承FileManager中已缓存的数据与矩阵定义，不需要序列化传输；只支持cpu引擎（cudf的CUDA上下文不能fork）
+    # 归并顺序与串行不同，float32权重可能存在舍入级别的差异
+    def train_parallel(self, workers=None, specs=None, resume=False):
+        if self.engine.is_gpu:
+            raise ValueError('train_parallel 只支持cpu引擎')
+        global _WORKER_STATE
+        specs = self.specs if specs is None else specs
+        pending = {spec.name: self._pending(spec, resume) for spec in specs}
+        specs = [spec for spec in specs if pending[spec.name]]
+        if not specs:
+            print('All pieces are already done.')
+            return self
+        acc = {spec.name: TreeAccumulator() for spec in specs}
+        groups = self._groups()
+        workers = workers or os.cpu_count()
+        print(f'Processing {len(groups)} groups of {self.fm.READ_CT} files with {workers} workers...')
+
+        _WORKER_STATE = (self, specs)
+        try:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                for (j, k, files), (result, stats) in zip(groups, pool.map(_group_task, [files for j, k, files in groups])):
+                    profiler.merge(stats)
+                    for name, parts in result.items():
+                        acc[name].add(parts)
+                    print(k, ', ', end='')
+        finally:
+            _WORKER_STATE = None
+        print()
+
+        self._save_all(acc, specs, pending)
+        return self
+
+    # 训练结束后同时导出CSR格式，供推理时内存映射加载
+    # resume=True 时从运行清单继续（中断后重新运行只计算未完成的分片）；
+    # matrices、pieces 指定只计算部分矩阵的部分分片（逐片计算），全部分片都完成后才导出CSR
+    # fused=None 时自动选择：cpu引擎单次扫描；cudf引擎下不溢写的单次扫描会把全部分片的累加结果同时放在显存中
+    # （disk_pieces过小可能会导致爆显存的原因），因此只有指定spill_dir时才单次扫描，否则逐片计算
+    @staged
+    def train(self, fused=None, spill_dir=None, workers=1, resume=False, matrices=None, pieces=None):
+        specs = self.specs if matrices is None else [spec for spec in self.specs if spec.name in matrices]
+        if fused is None:
+            fused = not self.engine.is_gpu or spill_dir is not None
+        if pieces is not None:
+            invalid = [p for p in pieces if not any(0 <= p < spec.pieces for spec in specs)]
+            if invalid:
+                raise ValueError(f'分片号 {invalid} 超出了矩阵的分片数：{ {spec.name: spec.pieces for spec in specs} }')
+            self.train_by_piece(specs, pieces=pieces, resume=resume)
+        elif workers > 1:
+            self.train_parallel(workers=workers, specs=specs, resume=resume)
+        elif fused:
+            self.train_fused(specs, spill_dir=spill_dir, resume=resume)
+        else:
+            self.train_by_piece(specs, resume=resume)
+        missing = {spec.name: self._pending(spec, True) for spec in self.specs}
+        if any(missing.values()):
+            print('Pieces still pending, CSR export skipped:', {name: p for name, p in missing.items() if p})
+            return self
+        return self.export_csr()
+
+    # 读取一种共现矩阵的全部分片parquet；scales为各分片权重的系数（见incremental.py），None表示不缩放
+    def _read_pieces(self, prefix, disk_pieces, scales=None):
+        dfs = []
+        for k in range(disk_pieces):
+            df = pd.read_parquet(f'{self.output_dir}/{prefix}_{k}.pqt')
+            if scales is not None and scales[k] != 1.0:
+                df['wgt'] = (df.wgt * scales[k]).astype('float32')
+            dfs.append(df)
+        return pd.concat(dfs, ignore_index=True)
+
+    def _csr_dir(self, prefix):
+        return f'{self.output_dir}/csr/{prefix}'
+
+    # 将训练输出的parquet分片转换为CSR格式（indptr/indices/weights.npy），同时记录分片的指纹
+    # scales 为 {矩阵名: 各分片权重的系数}，用于增量更新后尺度不同的分片
+    @staged
+    def export_csr(self, scales=None):
+        for spec in self.specs:
+            self._export_csr(spec.prefix, spec.pieces, None if scales is None else scales[spec.name])
+        return self
+
+    def _export_csr(self, prefix, disk_pieces, scales=None):
+        CSRMatrix.from_frame(self._read_pieces(prefix, disk_pieces, scales)).save(
+            self._csr_dir(prefix), source=self._pieces_fingerprint(prefix, disk_pieces))
+
+    # parquet分片的指纹（路径、大小与修改时间），分片被重新写入后与CSR中记录的不同
+    def _pieces_fingerprint(self, prefix, disk_pieces):
+        return fingerprint_files([f'{self.output_dir}/{prefix}_{k}.pqt' for k in range(disk_pieces)])
+
+    # CSR不存在，或者导出后分片被重新计算过（train_fused、train_by_piece 等不会重新导出）时需要重新转换
+    def _csr_stale(self, prefix, disk_pieces):
+        path = self._csr_dir(prefix)
+        return not CSRMatrix.exists(path) or CSRMatrix.source_of(path) != self._pieces_fingerprint(prefix, disk_pieces)
+
+    # fmt='csr' 时以内存映射方式打开CSR矩阵（不存在或已过期时先从parquet转换），fmt='dict' 时转换为 dict[int, list[int]]
+    @staged
+    def load_metrix(self, fmt='csr'):
+        for spec in self.specs:
+            attr, prefix, disk_pieces = spec.attr, spec.prefix, spec.pieces
+            if fmt == 'csr':
+                if self._csr_stale(prefix, disk_pieces): self._export_csr(prefix, disk_pieces)
+                setattr(self, attr, CSRMatrix.load(self._csr_dir(prefix)))
+            else:
+                matrix = self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/{prefix}_0.pqt'))
+                for k in range(1, disk_pieces):
+                    matrix.update(self.fm.pqt_to_dict(pd.read_parquet(f'{self.output_dir}/{prefix}_{k}.pqt')))
+                setattr(self, attr, matrix)
 
         self.test_df = self.fm.load_test()
         print('Test data has shape', self.test_df.shape)
 
-        self.top_clicks = self.test_df.loc[self.test_df['type'] == 'clicks', 'aid'].value_counts().index.values[:20]
-        self.top_orders = self.test_df.loc[self.test_df['type'] == 'orders', 'aid'].value_counts().index.values[:20]
-
-        print('Here are size of our 3 co-visitation matrices:')
-        print(len(self.top_20_clicks), len(self.top_20_buy2buy), len(self.top_20_buys))
+        # 测试期间最热门的商品，用于补足不到20个的预测（type列为 type_labels 编码后的整数）
+        types = self.test_df['type']
+        self.top_clicks = self.test_df.loc[types == self.fm.type_labels['clicks'], 'aid'].value_counts().index.values[:20]
+        self.top_orders = self.test_df.loc[types == self.fm.type_labels['orders'], 'aid'].value_counts().index.values[:20]
+
+        print(f'Here are size of our {len(self.specs)} co-visitation matrices:')
+        print(*(len(getattr(self, spec.attr)) for spec in self.specs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default='./parquet')
+    parser.add_argument('--output-dir', default='./handled_files')
+    parser.add_argument('--engine', default='auto')
+    parser.add_argument('--store-dir', default=None, help='规范化事件存储目录（需已构建）')
+    parser.add_argument('--matrix', nargs='+', default=None, help='只计算这些矩阵，默认全部')
+    parser.add_argument('--piece', type=int, nargs='+', default=None, help='只计算这些分片（逐片计算），默认全部')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--spill-dir', default=None, help='单次扫描时分片结果的溢写目录（cudf引擎下指定后才单次扫描）')
+    parser.add_argument('--no-resume', action='store_true', help='忽略运行清单，重新计算全部分片')
+    args = parser.parse_args()
+
+    fm = FileManager(args.root, engine=args.engine, lazy=True, store_dir=args.store_dir)
+    CoVisitationMatrix(fm, output_dir=args.output_dir).train(spill_dir=args.spill_dir, workers=args.workers,
+                                                              resume=not args.no_resume, matrices=args.matrix,
+                                                              pieces=args.piece)
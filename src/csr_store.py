@@ -0,0 +1,122 @@
+import json, os
+from collections.abc import Mapping
+import numpy as np, pandas as pd
+
+'''
+共现矩阵的CSR存储：indptr/indices/weights 三个数组保存为 .npy，加载时通过 np.memmap 只读映射，
+多个推理进程可以共享同一份页缓存，启动时不需要把数据转换为Python的 dict[int, list[int]]
+'''
+
+
+class CSRMatrix(Mapping):
+    '''
+     按商品id直接索引的CSR矩阵：第aid行的邻居为 indices[indptr[aid]:indptr[aid + 1]]，顺序与保存时一致（权重降序）
+     实现了Mapping接口（m[aid]、aid in m、len(m)、m.get(aid)），可以直接替换原来的 dict[int, list[int]]
+     weighted=False 表示构建时没有权重（例如由dict转换），weights 全部为1，不能用于按权重打分
+    '''
+
+    FILES = ('indptr', 'indices', 'weights')
+
+    def __init__(self, indptr, indices, weights, weighted=True):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.weighted = weighted
+        self._len = None
+
+    # 由 (aid_x, aid_y, wgt) 表构建，表中同一aid_x的行保持原有顺序
+    @classmethod
+    def from_frame(cls, df):
+        aid_x = df.aid_x.values
+        if len(aid_x) and (aid_x[1:] < aid_x[:-1]).any():
+            df = df.iloc[np.argsort(aid_x, kind='stable')]
+            aid_x = df.aid_x.values
+        n_rows = int(aid_x.max()) + 1 if len(aid_x) else 0
+        indptr = np.zeros(n_rows + 1, dtype='int64')
+        np.cumsum(np.bincount(aid_x, minlength=n_rows), out=indptr[1:])
+        if 'wgt' in df:
+            return cls(indptr, df.aid_y.values.astype('int32'), df.wgt.values.astype('float32'))
+        return cls(indptr, df.aid_y.values.astype('int32'), np.ones(len(df), dtype='float32'), weighted=False)
+
+    # dict[int, list[int]] 只保存了邻居的顺序，转换后 weighted=False
+    @classmethod
+    def from_dict(cls, d):
+        aid_x = np.repeat(np.fromiter(d.keys(), dtype='int64', count=len(d)), [len(v) for v in d.values()])
+        aid_y = np.fromiter((a for v in d.values() for a in v), dtype='int32', count=len(aid_x))
+        return cls.from_frame(pd.DataFrame({'aid_x': aid_x, 'aid_y': aid_y}))
+
+    # source 为来源数据的标记（例如parquet分片的指纹），与数组一起保存，加载前可用 source_of 判断是否过期
+    # weighted 保存在 meta.json 中，加载后没有权重的矩阵仍然不能用于按权重打分
+    def save(self, path, source=None):
+        os.makedirs(path, exist_ok=True)
+        for name in self.FILES:
+            np.save(f'{path}/{name}.npy', getattr(self, name))
+        with open(f'{path}/meta.json', 'w') as f:
+            json.dump({'weighted': self.weighted}, f)
+        if source is not None:
+            with open(f'{path}/source.txt', 'w') as f:
+                f.write(source)
+        return self
+
+    @staticmethod
+    def source_of(path):
+        if not os.path.exists(f'{path}/source.txt'):
+            return None
+        with open(f'{path}/source.txt') as f:
+            return f.read()
+
+    # mmap=True时以只读内存映射打开，数据按需从页缓存读取；np.asarray 只去掉memmap子类（仍然是同一块映射），
+    # 避免每次索引都经过 memmap.__getitem__ / __array_finalize__
+    @classmethod
+    def load(cls, path, mmap=True):
+        mode = 'r' if mmap else None
+        weighted = True
+        if os.path.exists(f'{path}/meta.json'):
+            with open(f'{path}/meta.json') as f:
+                weighted = json.load(f)['weighted']
+        arrays = (np.asarray(np.load(f'{path}/{name}.npy', mmap_mode=mode)) for name in cls.FILES)
+        return cls(*arrays, weighted=weighted)
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(f'{path}/{name}.npy') for name in CSRMatrix.FILES)
+
+    @property
+    def n_rows(self):
+        return len(self.indptr) - 1
+
+    # 返回第aid行的 (邻居数组, 权重数组)，aid不存在时返回空数组
+    def row(self, aid):
+        if not 0 <= aid < self.n_rows:
+            return self.indices[:0], self.weights[:0]
+        begin, end = self.indptr[aid], self.indptr[aid + 1]
+        return self.indices[begin:end], self.weights[begin:end]
+
+    # 按aids顺序展开每个aid的邻居（邻居保持原顺序），返回 (aids中的序号, 邻居aid, 权重)，不存在的aid没有邻居
+    def gather(self, aids):
+        valid = (aids >= 0) & (aids < self.n_rows)
+        safe = np.where(valid, aids, 0)
+        begin = np.where(valid, self.indptr[safe], 0)
+        counts = np.where(valid, self.indptr[safe + 1], 0) - begin
+        q = np.repeat(np.arange(len(aids)), counts)
+        pos = np.repeat(begin - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+        return q, np.asarray(self.indices[pos]).astype('int64'), np.asarray(self.weights[pos])
+
+    def __getitem__(self, aid):
+        if not 0 <= aid < self.n_rows or self.indptr[aid] == self.indptr[aid + 1]:
+            raise KeyError(aid)
+        return self.indices[self.indptr[aid]:self.indptr[aid + 1]].tolist()
+
+    def __contains__(self, aid):
+        return 0 <= aid < self.n_rows and self.indptr[aid] != self.indptr[aid + 1]
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.diff(self.indptr)).tolist())
+
+    def __len__(self):
+        if self._len is None:
+            self._len = int(np.count_nonzero(np.diff(self.indptr)))
+        return self._len
+
+    def __repr__(self):
+        return f'CSRMatrix(rows={len(self)}, nnz={len(self.indices)})'
@@ -0,0 +1,59 @@
+import pandas as pd
+
+'''
+计算引擎：GPU 节点使用 cudf，CPU 节点使用 pandas（两者接口一致，共现矩阵的向量化代码可以直接复用）
+'''
+
+ENGINES = ('cudf', 'cpu')
+
+
+def has_cudf():
+    try:
+        import cudf  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class Engine:
+    '''
+     name可选 'cudf'、'cpu' 或 'auto'（有cudf时使用GPU，否则退回CPU）
+    '''
+
+    def __init__(self, name='auto'):
+        if name == 'auto':
+            name = 'cudf' if has_cudf() else 'cpu'
+        if name not in ENGINES:
+            raise ValueError(f'未知的计算引擎：{name}，可选值为 {ENGINES}')
+        self.name = name
+        if self.is_gpu:
+            import cudf
+            self.xd = cudf
+        else:
+            self.xd = pd
+
+    @property
+    def is_gpu(self):
+        return self.name == 'cudf'
+
+    @property
+    def version(self):
+        return f'{self.xd.__name__} {self.xd.__version__}'
+
+    # 主机内存中的pandas DataFrame转换为引擎上的DataFrame
+    def from_pandas(self, df):
+        return self.xd.DataFrame(df) if self.is_gpu else df
+
+    # Arrow表转换为引擎上的DataFrame：cudf直接从Arrow拷贝到显存，pandas按列拆分块以尽量避免拷贝
+    def from_arrow(self, table):
+        return self.xd.DataFrame.from_arrow(table) if self.is_gpu else table.to_pandas(split_blocks=True)
+
+    # 引擎上的DataFrame转换回pandas，用于保存结果
+    def to_pandas(self, df):
+        return df.to_pandas() if self.is_gpu else df
+
+    def concat(self, dfs, **kwargs):
+        return self.xd.concat(dfs, **kwargs)
+
+    def __repr__(self):
+        return f'Engine({self.name!r})'
@@ -0,0 +1,191 @@
+import argparse, glob, json, os, shutil, time
+import numpy as np, pandas as pd
+import pyarrow as pa, pyarrow.compute as pc, pyarrow.parquet as pq
+
+from src.candidates import BUYS_COUNT, BUYS_WEIGHTED
+from src.co_visitation_matrix import CoVisitationMatrix
+from src.file_manager import FileManager
+from src.handcrafted_rules import HandCraftedRules
+from src.matrix_spec import DAY, DEFAULT_SPECS
+from src.submission import PAD, TARGETS, WIDTH, load_array, to_array
+
+'''
+本地验证：把训练集按时间切分为历史与最后days天，在历史上构建共现矩阵，对最后days天内开始的session只保留
+随机长度的前缀作为测试集，其余事件作为答案，计算加权的Recall@20：
+    clicks 为前缀之后的第一次点击，carts / orders 为前缀之后加购物车 / 购买的全部商品
+    每类的召回 = 命中数之和 / min(20, 答案数) 之和，score = 0.10 * clicks + 0.30 * carts + 0.60 * orders
+用于比较分片数、保留的邻居数、时间窗口等参数在速度与准确率上的取舍：
+    python -m src.evaluation --root ./parquet --val-dir ./validation --pieces 4 --top-k 20
+'''
+
+RECALL_WEIGHTS = {'clicks': 0.10, 'carts': 0.30, 'orders': 0.60}
+TYPE_LABELS = {'clicks': 0, 'carts': 1, 'orders': 2}
+
+
+def _type_codes(types):
+    if pa.types.is_integer(types.type):
+        return types.to_numpy()
+    return pc.index_in(pc.cast(types, pa.string()), value_set=pa.array(list(TYPE_LABELS))).to_numpy()
+
+
+# 一个文件中最后days天内开始的session：随机截断为前缀（至少1条事件），前缀之后的事件转换为答案
+def _truncate(table, split_ts, rng):
+    order = np.lexsort((table['ts'].to_numpy(), table['session'].to_numpy()))
+    table = table.take(order)
+    session, ts = table['session'].to_numpy(), table['ts'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, session[1:] != session[:-1]])
+    lengths = np.diff(np.r_[starts, len(session)])
+    # 只保留在split_ts之后开始、至少有2条事件的session
+    chosen = (ts[starts] >= split_ts) & (lengths >= 2)
+    cuts = np.zeros(len(starts), dtype='int64')
+    cuts[chosen] = rng.integers(1, lengths[chosen])
+    position = np.arange(len(session)) - np.repeat(starts, lengths)
+    in_test = np.repeat(chosen, lengths)
+    is_input = in_test & (position < np.repeat(cuts, lengths))
+    is_label = in_test & ~is_input
+
+    labels = pd.DataFrame({'session': session[is_label].astype('int32'),
+                           'type': _type_codes(table['type'])[is_label].astype('int8'),
+                           'aid': table['aid'].to_numpy()[is_label].astype('int32')})
+    clicks = labels[labels.type == 0].drop_duplicates('session')  # 只保留前缀之后的第一次点击
+    buys = labels[labels.type > 0].drop_duplicates()
+    return table.filter(pa.array(is_input)), pd.concat([clicks, buys])
+
+
+def split_dataset(root, val_dir, days=7, seed=0):
+    '''
+     把 {root}/train_parquet 切分为 {val_dir}/train_parquet（split_ts 之前的事件）、{val_dir}/test_parquet
+     （split_ts 之后开始的session的前缀）与 {val_dir}/labels.parquet（session, type, aid），文件格式与原始数据相同；
+     split_ts 为训练集最后一个事件之前days天，跨越split_ts的session只保留之前的部分；每个session须在同一个文件中
+     切分参数最后写入 {val_dir}/split.json，validate 据此判断已有的切分是否可以沿用
+    '''
+    files = sorted(glob.glob(f'{root}/train_parquet/*'))
+    for name in ('train_parquet', 'test_parquet'):
+        shutil.rmtree(f'{val_dir}/{name}', ignore_errors=True)  # 文件数可能与上次不同，先清除上次的切分
+    ts_end = max(pc.max(pq.read_table(f, columns=['ts'])['ts']).as_py() for f in files)
+    scale = 1000 if ts_end > 1e11 else 1  # 原始数据的ts为毫秒
+    split_ts = ts_end - days * DAY * scale
+    rng = np.random.default_rng(seed)
+    os.makedirs(f'{val_dir}/train_parquet', exist_ok=True)
+    os.makedirs(f'{val_dir}/test_parquet', exist_ok=True)
+    labels = []
+    for i, f in enumerate(files):
+        table = pq.read_table(f)
+        history = table.filter(pc.less(table['ts'], split_ts))
+        pq.write_table(history, f'{val_dir}/train_parquet/{i:03d}.parquet')
+        test, answer = _truncate(table, split_ts, rng)
+        if test.num_rows:
+            pq.write_table(test, f'{val_dir}/test_parquet/{i:03d}.parquet')
+        labels.append(answer)
+    labels = pd.concat(labels, ignore_index=True)
+    labels.to_parquet(f'{val_dir}/labels.parquet')
+    with open(f'{val_dir}/split.json', 'w') as f:
+        json.dump(_split_params(root, days, seed) | {'split_ts': split_ts}, f, indent=1)
+    print(f'Validation split at ts {split_ts}: {labels.session.nunique()} test sessions, {len(labels)} labels')
+    return labels
+
+
+def _split_params(root, days, seed):
+    return {'root': os.path.abspath(root), 'days': days, 'seed': seed}
+
+
+# 已有的切分是否由相同的参数生成（中断的切分没有split.json，会重新进行）
+def _split_matches(root, val_dir, days, seed):
+    if not os.path.exists(f'{val_dir}/split.json'):
+        return False
+    with open(f'{val_dir}/split.json') as f:
+        record = json.load(f)
+    return all(record.get(k) == v for k, v in _split_params(root, days, seed).items())
+
+
+# sessions [n]（升序）与 predictions [n, 3, WIDTH] 为 submission.to_array 的结果，labels 为 split_dataset 的答案
+# 每条答案只需在对应session与类型的WIDTH个预测中查找，不需要逐session构建集合
+def recall_at_20(sessions, predictions, labels):
+    session, types, aid = labels.session.values, labels.type.values.astype('int64'), labels.aid.values
+    row = np.minimum(np.searchsorted(sessions, session), max(len(sessions) - 1, 0))
+    found = sessions[row] == session if len(sessions) else np.zeros(len(session), dtype=bool)
+    candidates = np.asarray(predictions[row[found], types[found], :WIDTH])
+    hit = np.zeros(len(session), dtype=bool)
+    hit[found] = ((candidates == aid[found, None]) & (candidates != PAD)).any(axis=1)
+
+    # 每个 (session, 类型) 的答案数，最多计WIDTH个
+    keys, group, counts = np.unique(session.astype('int64') * 3 + types, return_inverse=True, return_counts=True)
+    hits = np.bincount(group, weights=hit, minlength=len(counts))
+    group_types = keys % 3
+
+    result = {}
+    for name in TARGETS:
+        code = TYPE_LABELS[name]
+        mask = group_types == code
+        denominator = np.minimum(counts[mask], WIDTH).sum()
+        result[name] = float(np.minimum(hits[mask], WIDTH).sum() / denominator) if denominator else 0.0
+    result['score'] = sum(RECALL_WEIGHTS[name] * result[name] for name in TARGETS)
+    return result
+
+
+# 评估已保存的预测（submission.save 的 array_path）
+def evaluate(pred_path, labels_path):
+    sessions, predictions = load_array(pred_path)
+    return recall_at_20(sessions, predictions, pd.read_parquet(labels_path))
+
+
+def validate(root, val_dir, specs=DEFAULT_SPECS, engine='auto', workers=1, output_dir=None, days=7, seed=0,
+             resume=True, buy_scorer=BUYS_COUNT):
+    '''
+     切分（参数与已有的切分不同时才重新进行）→ 在历史上构建共现矩阵 → 执行规则 → 计算Recall@20，同时返回各步骤的耗时
+     output_dir 默认为 {val_dir}/matrices；resume=True 时矩阵定义与输入未变化的分片不会重新计算
+     buy_scorer 为购买预测合并候选的方式（见candidates.py）
+    '''
+    seconds = {}
+    start = time.perf_counter()
+    if not _split_matches(root, val_dir, days, seed):
+        split_dataset(root, val_dir, days, seed)
+    seconds['split'] = time.perf_counter() - start
+
+    output_dir = output_dir or f'{val_dir}/matrices'
+    os.makedirs(output_dir, exist_ok=True)
+    cvm = CoVisitationMatrix(FileManager(val_dir, engine=engine), output_dir=output_dir, specs=specs)
+    start = time.perf_counter()
+    cvm.fm.read()
+    cvm.train(workers=workers, resume=resume)
+    seconds['train'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cvm.load_metrix()
+    rules = HandCraftedRules(buy_scorer)
+    rules.train(cvm, workers=workers)
+    sessions, predictions = to_array(rules.pred_df_clicks, rules.pred_df_buys)
+    seconds['predict'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = recall_at_20(sessions, predictions, pd.read_parquet(f'{val_dir}/labels.parquet'))
+    seconds['recall'] = time.perf_counter() - start
+    return result, seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default='./parquet')
+    parser.add_argument('--val-dir', default='./validation')
+    parser.add_argument('--output-dir', default=None, help='共现矩阵的输出目录，默认为 {val-dir}/matrices')
+    parser.add_argument('--engine', default='auto')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--days', type=int, default=7, help='作为测试集的最后天数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pieces', type=int, default=None, help='所有矩阵的分片数，默认使用各矩阵的定义')
+    parser.add_argument('--top-k', type=int, default=None, help='所有矩阵保留的邻居数')
+    parser.add_argument('--window-days', type=float, default=None, help='所有矩阵商品对的时间窗口（天）')
+    parser.add_argument('--no-resume', action='store_true')
+    parser.add_argument('--weighted-buys', action='store_true', help='购买预测按共现矩阵的权重合并候选（BUYS_WEIGHTED）')
+    args = parser.parse_args()
+
+    changes = {'pieces': args.pieces, 'top_k': args.top_k,
+               'window': None if args.window_days is None else int(args.window_days * DAY)}
+    changes = {k: v for k, v in changes.items() if v is not None}
+    specs = [spec.replace(**changes) for spec in DEFAULT_SPECS]
+    result, seconds = validate(args.root, args.val_dir, specs, engine=args.engine, workers=args.workers,
+                               output_dir=args.output_dir, days=args.days, seed=args.seed, resume=not args.no_resume,
+                               buy_scorer=BUYS_WEIGHTED if args.weighted_buys else BUYS_COUNT)
+    print(*specs, sep='\n')
+    print('Recall@20:', {k: round(v, 5) for k, v in result.items()})
+    print('Seconds:', {k: round(v, 3) for k, v in seconds.items()})
@@ -0,0 +1,109 @@
+import json, os, shutil
+import numpy as np
+import pyarrow as pa
+
+from src.top_k import group_bounds
+
+'''
+规范化事件的列式存储：原始parquet只需转换一次（ts转为秒、type转为int8），按 (session, ts) 稳定排序后
+每列保存为一个 .npy 文件，之后的运行直接以内存映射方式读取，不再需要逐文件做类型转换
+目录结构：{store_dir}/{train_parquet|test_parquet}/{文件名}/{session,aid,ts,type}.npy，manifest.json 记录文件顺序
+以及每个原始文件的路径、大小与修改时间，原始文件增加、删除或被修改后存储即过期（见 matches）
+'''
+
+
+class EventStore:
+    COLUMNS = {'session': 'int32', 'aid': 'int32', 'ts': 'int32', 'type': 'int8'}
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.manifest = None
+        if self.exists():
+            with open(self._manifest_path()) as f:
+                self.manifest = json.load(f)
+
+    def _manifest_path(self):
+        return f'{self.store_dir}/manifest.json'
+
+    def exists(self):
+        return os.path.exists(self._manifest_path())
+
+    @staticmethod
+    def _stat(filename):
+        stat = os.stat(filename)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    # 存储是否由这些原始文件构建：文件集合相同，且每个文件的大小与修改时间都与构建时相同
+    def matches(self, files):
+        if self.manifest is None:
+            return False
+        recorded = {os.path.abspath(e['source']): (e.get('size'), e.get('mtime_ns')) for e in self.manifest['files']}
+        current = {}
+        for f in files:
+            stat = self._stat(f)
+            current[os.path.abspath(f)] = (stat['size'], stat['mtime_ns'])
+        return recorded == current
+
+    # 由原始文件构建；read_raw(filename) 返回已转换类型的 pyarrow.Table（FileManager中的原始读取函数）
+    # 重新构建时先删除清单与旧的数据，中断的构建不会被当作可用的存储
+    def build(self, files, read_raw):
+        if os.path.exists(self._manifest_path()):
+            os.remove(self._manifest_path())
+        for split in {os.path.basename(os.path.dirname(f)) for f in files}:
+            shutil.rmtree(f'{self.store_dir}/{split}', ignore_errors=True)
+        self.manifest, entries = None, []
+        if hasattr(self, '_first'):
+            del self._first
+        for f in files:
+            table = read_raw(f)
+            arrays = {col: table[col].to_numpy().astype(dtype, copy=False) for col, dtype in self.COLUMNS.items()}
+            order = np.lexsort((arrays['ts'], arrays['session']))  # 稳定排序，ts相同的事件保持原始顺序
+            split = os.path.basename(os.path.dirname(f))
+            path = f'{self.store_dir}/{split}/{os.path.splitext(os.path.basename(f))[0]}'
+            os.makedirs(path, exist_ok=True)
+            for col, values in arrays.items():
+                np.save(f'{path}/{col}.npy', values[order])
+            first = int(arrays['session'][order[0]]) if len(order) else -1
+            entries.append({'path': path, 'source': f, **self._stat(f), 'split': split, 'rows': len(order),
+                            'first_session': first})
+            print(f'{f} -> {path} ({len(order)} rows)')
+
+        tmp = f'{self._manifest_path()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'columns': self.COLUMNS, 'files': entries}, f, indent=1)
+        os.replace(tmp, self._manifest_path())
+        self.manifest = {'columns': self.COLUMNS, 'files': entries}
+        return self
+
+    def files(self, split=None):
+        return [e['path'] for e in self.manifest['files'] if split is None or e['split'] == split]
+
+    def first_session(self, path):
+        if not hasattr(self, '_first'):
+            self._first = {e['path']: e['first_session'] for e in self.manifest['files']}
+        return self._first[path]
+
+    # 以内存映射方式读取一个文件的全部列
+    def read(self, path):
+        return pa.table({col: np.load(f'{path}/{col}.npy', mmap_mode='r') for col in self.COLUMNS})
+
+
+def reverse_ts_runs(session, ts):
+    '''
+     输入已按 (session, ts) 升序稳定排列，返回下标顺序，使结果按 session 升序、ts 降序排列，
+     ts相同的事件保持原来的先后（与 sort_values(['session', 'ts'], ascending=[True, False]) 的稳定排序一致），O(n)不需要排序
+    '''
+    n = len(session)
+    if n == 0:
+        return np.zeros(0, dtype='int64')
+    s_starts, s_counts = group_bounds(session)
+    s_ends = np.repeat(s_starts + s_counts, s_counts)
+    s_starts = np.repeat(s_starts, s_counts)
+    r_starts = np.flatnonzero(np.r_[True, (session[1:] != session[:-1]) | (ts[1:] != ts[:-1])])
+    r_counts = np.diff(np.r_[r_starts, n])
+    r_ends = np.repeat(r_starts + r_counts, r_counts)
+    r_starts = np.repeat(r_starts, r_counts)
+    i = np.arange(n)
+    order = np.empty(n, dtype='int64')
+    order[s_starts + (s_ends - r_ends) + (i - r_starts)] = i
+    return order
@@ -1,53 +1,152 @@
-import glob, cudf
+import glob, os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np, pandas as pd
+import pyarrow as pa, pyarrow.compute as pc, pyarrow.parquet as pq
 
+from src.engine import Engine
+from src.event_store import EventStore
+from utils.profiler import profiler, staged
 from utils.run_time import run_time
 
 
 class FileManager:
     '''
      用于读取分片的parquet格式原始数据，并且建立映射表，供外部按照文件名获取DataFrame
+     lazy=True 时不预先加载全部文件，而是按需读取并放入按字节数限制（cache_bytes）的LRU缓存，
+     可以通过 prefetch() 在后台线程中提前读取下一组文件
+     store_dir 指定规范化事件存储的目录（见 src/event_store.py）：已构建且与原始文件一致时直接从存储读取，
+     未构建或原始文件已变化时读取原始文件，可以调用 preprocess() 一次性转换（重新构建）
     '''
 
-    def __init__(self, root="./parquet"):
-        self.data_cache = {}  # 缓存的文件字典 （key：文件名， val:DataFrame）
+    COLUMNS = ['session', 'aid', 'ts', 'type']  # 只读取需要的列
+
+    def __init__(self, root="./parquet", engine='auto', lazy=False, cache_bytes=None, prefetch_workers=2,
+                 store_dir=None):
+        self.data_cache = OrderedDict()  # 缓存的文件字典 （key：文件名， val:pyarrow.Table），按最近使用排序
         self.type_labels = {'clicks': 0, 'carts': 1, 'orders': 2}  # 标签映射表
         self.root = root
-        self.files = glob.glob(f'{self.root}/*_parquet/*')
-        self.files_len = len(self.files)
+        self.store = EventStore(store_dir) if store_dir is not None else None
+        raw_files = glob.glob(f'{self.root}/*_parquet/*')
+        # 是否从规范化存储读取（此时每个文件内的事件已按 (session, ts) 升序排列）；原始文件不存在时直接使用存储
+        self.presorted = self.store is not None and (self.store.matches(raw_files) if raw_files else self.store.exists())
+        if self.store is not None and self.store.exists() and not self.presorted:
+            print(f'规范化存储 {store_dir} 与 {self.root} 中的原始文件不一致，改为读取原始文件，调用 preprocess() 重新构建')
+        self._set_files(self.store.files() if self.presorted else raw_files)
         self.READ_CT = 3
+        self.engine = engine if isinstance(engine, Engine) else Engine(engine)  # 计算引擎（cudf或cpu）
+        self.lazy = lazy
+        self.cache_bytes = cache_bytes  # 缓存上限（字节），None表示不限制
+        self.cached_bytes = 0
+        self.prefetch_workers = prefetch_workers
+        self._pending = {}  # 正在后台读取的文件（key：文件名，val：Future）
+        self._pool, self._pool_pid = None, None
+
+    def _set_files(self, files):
+        self.files = files
+        self.files_len = len(self.files)
         self.CHUNK = int(np.ceil(self.files_len / 6))
 
-    # 读入
+    # 一次性预处理：把原始parquet转换为规范化存储，之后的读取都直接使用存储；存储与原始文件不一致时重新构建
+    @run_time
+    def preprocess(self):
+        if self.store is None:
+            raise ValueError('需要先在构造时指定 store_dir')
+        if not self.presorted:
+            self.store.build(self.files, self.__read_raw)
+            self.presorted = True
+        self._set_files(self.store.files())
+        self.clear_cache()
+
+    # 文件中第一个session，用于把一组已排序的文件按session顺序拼接
+    def first_session(self, filename):
+        return self.store.first_session(filename)
+
+    # 读入（lazy模式下不预先加载，在read_file时按需读取）
     @run_time
     def read(self):
+        if self.lazy:
+            print(f"按需读取文件，缓存上限 {self.cache_bytes} 字节")
+            return
         print("开始建立文件字典")
         for f in self.files: self.data_cache[f] = self.__read_file_to_cache(f)
+        self.cached_bytes = sum(t.nbytes for t in self.data_cache.values())
         print("文件字典建立完毕")
 
-    # 用于根据路径读取parquet文件
     def __read_file_to_cache(self, filename):
-        df = pd.read_parquet(filename)
-        df.ts = (df.ts / 1000).astype('int32')
-        df['type'] = df['type'].map(self.type_labels).astype('int8')
-        return df
+        with profiler.stage('read_file') as stage:
+            if self.presorted:
+                table = self.store.read(filename)
+                stage.bytes_read = sum(os.path.getsize(f'{filename}/{col}.npy') for col in table.column_names)
+            else:
+                table = self.__read_raw(filename)
+                stage.bytes_read = os.path.getsize(filename)
+            stage.rows_out = table.num_rows
+        return table
+
+    # 用于根据路径读取parquet文件：只读取需要的列，在Arrow中完成类型转换，避免经过pandas的中间拷贝
+    def __read_raw(self, filename):
+        table = pq.read_table(filename, columns=self.COLUMNS)
+        ts = pc.cast(pc.divide(table['ts'], 1000), pa.int32())
+        types = table['type']
+        if not pa.types.is_integer(types.type):
+            types = pc.index_in(pc.cast(types, pa.string()), value_set=pa.array(list(self.type_labels)))
+        types = pc.cast(types, pa.int8())
+        table = table.set_column(self.COLUMNS.index('ts'), 'ts', ts)
+        table = table.set_column(self.COLUMNS.index('type'), 'type', types)
+        return table.replace_schema_metadata(None)  # 去掉文件中的pandas元数据，避免转换时恢复为原来的字符串类型
+
+    # 后台读取线程池；fork出的子进程中不能复用父进程的线程池，需要重新创建
+    def _executor(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+            self._pool_pid = os.getpid()
+            self._pending = {}
+        return self._pool
+
+    # 在后台线程中提前读取文件（一般是下一组READ_CT个文件），只在lazy模式下生效
+    def prefetch(self, files):
+        if not self.lazy:
+            return
+        for f in files:
+            if f not in self.data_cache and f not in self._pending:
+                self._pending[f] = self._executor().submit(self.__read_file_to_cache, f)
+
+    # 放入缓存，超过上限时淘汰最久未使用的文件
+    def _put(self, filename, table):
+        self.data_cache[filename] = table
+        self.cached_bytes += table.nbytes
+        while self.cache_bytes is not None and self.cached_bytes > self.cache_bytes and len(self.data_cache) > 1:
+            _, evicted = self.data_cache.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
 
-    # 用于直接从data_cache文件缓存映射表中读取数据
+    # 用于直接从data_cache文件缓存映射表中读取数据，未缓存的文件直接从磁盘读取（lazy模式下读取后放入缓存）
     def read_file(self, filename):
-        return cudf.DataFrame(self.data_cache[filename])
+        table = self.data_cache.get(filename)
+        if table is not None:
+            self.data_cache.move_to_end(filename)
+        else:
+            future = self._pending.pop(filename, None) if self._pool_pid == os.getpid() else None
+            table = future.result() if future is not None else self.__read_file_to_cache(filename)
+            if self.lazy: self._put(filename, table)
+        return self.engine.from_arrow(table)
 
     # 清理
     def clear_cache(self):
-        self.data_cache = {}
+        self.data_cache = OrderedDict()
+        self.cached_bytes = 0
+        self._pending = {}
 
     # 单独加载测试集
+    @staged
     def load_test(self):
         dfs = []
-        for e, chunk_file in enumerate(glob.glob(f'{self.root}/test_parquet/*')):
-            chunk = pd.read_parquet(chunk_file)
-            chunk.ts = (chunk.ts / 1000).astype('int32')
-            chunk['type'] = chunk['type'].map(self.type_labels).astype('int8')
-            dfs.append(chunk)
+        if self.presorted:
+            files = sorted(self.store.files('test_parquet'), key=self.first_session)  # 拼接后整体按 (session, ts) 有序
+        else:
+            files = glob.glob(f'{self.root}/test_parquet/*')
+        for e, chunk_file in enumerate(files):
+            dfs.append(self.__read_file_to_cache(chunk_file).to_pandas())
         return pd.concat(dfs).reset_index(drop=True)  # .astype({"ts": "datetime64[ms]"})
 
     # pqt转换为dict
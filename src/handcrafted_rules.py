@@ -1,8 +1,23 @@
-import itertools
+import itertools, multiprocessing
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np, pandas as pd
 
+from src.batch_rules import BatchRules, _as_csr
+from src.candidates import BUYS_COUNT
 from src.co_visitation_matrix import CoVisitationMatrix
+from src.submission import save_array, to_array, write_csv
+from utils.profiler import profiler, staged
+
+_WORKER_STATE = None  # 并行模式下由主进程设置：(HandCraftedRules, 排序后的测试数据, 共现矩阵, BatchRules)，fork后工作进程直接使用
+
+
+# 工作进程的统计从空开始，随结果一起返回给主进程合并
+def _score_shard(bounds):
+    rules, test_df, cvm, batch = _WORKER_STATE
+    begin, end = bounds
+    profiler.reset()
+    return rules._score(test_df.iloc[begin:end], cvm, batch), profiler.drain()
 
 
 class HandCraftedRules:
@@ -10,12 +25,22 @@ class HandCraftedRules:
     pred_df_clicks = None
     pred_df_buys = None
 
-    def __init__(self):
-        pass
+    # buy_scorer 为 suggest_buys 合并共现矩阵候选的方式（见candidates.py），默认 BUYS_COUNT 与原规则的结果相同
+    def __init__(self, buy_scorer=BUYS_COUNT):
+        self.buy_scorer = buy_scorer
+        self._matrices = (None, None)  # (共现矩阵对象的id, {属性名: CSRMatrix})，dict格式的矩阵只转换一次
+
+    def _buy_matrices(self, cvm):
+        key = tuple(id(getattr(cvm, attr)) for attr in self.buy_scorer.attrs)
+        if self._matrices[0] != key:
+            self._matrices = (key, {attr: _as_csr(getattr(cvm, attr)) for attr in self.buy_scorer.attrs})
+        return self._matrices[1]
 
     def suggest_clicks(self, df, cvm: CoVisitationMatrix):
-        aids = df.aid.tolist()
-        types = df.type.tolist()
+        return self.suggest_clicks_list(df.aid.tolist(), df.type.tolist(), cvm)
+
+    # aids、types为按时间排序的一个session的历史商品与行为类型（列表形式，供在线服务直接调用）
+    def suggest_clicks_list(self, aids, types, cvm: CoVisitationMatrix):
         unique_aids = list(dict.fromkeys(aids[::-1]))  # 去重，并保持最近的aid在前面
 
         # 创建一个计数器来存储aid和它们的加权得分
@@ -37,54 +62,86 @@ class HandCraftedRules:
         return result + list(cvm.top_clicks)[:20 - len(result)]  # 如果结果不足20，用测试期间的点击补充
 
     def suggest_buys(self, df, cvm: CoVisitationMatrix):
-        aids = df.aid.tolist()
-        types = df.type.tolist()
+        return self.suggest_buys_list(df.aid.tolist(), df.type.tolist(), cvm)
 
+    def suggest_buys_list(self, aids, types, cvm: CoVisitationMatrix):
         # 去重
         unique_aids = list(dict.fromkeys(aids[::-1]))
-        df = df.loc[(df['type'] == 1) | (df['type'] == 2)]  # 筛选出加购物车和购买类型的数据
-        unique_buys = list(dict.fromkeys(df.aid.tolist()[::-1]))
+        buys = [aid for aid, t in zip(aids, types) if t == 1 or t == 2]  # 筛选出加购物车和购买类型的数据
+        unique_buys = list(dict.fromkeys(buys[::-1]))
+        matrices, queries = self._buy_matrices(cvm), {'all': unique_aids, 'buys': unique_buys}
 
-        # 创建一个计数器来存储aid和它们的加权得分
         if len(unique_aids) >= 20:
+            # 历史商品按时间与类型加权，再加上boost来源（原规则为buy2buy共现矩阵）中邻居的得分，获取得分最高的20个aid
             weights = np.logspace(0.5, 1, len(aids), base=2, endpoint=True) - 1
-            aids_temp = Counter()
-            for aid, w, t in zip(aids, weights, types):
-                aids_temp[aid] += w * self.type_weight_multipliers[t]  # 根据类型权重乘数更新aid的得分
-            # 从共现矩阵中获取与unique_buys相关的aid，并展平列表
-            aids3 = list(
-                itertools.chain(*[cvm.top_20_buy2buy[aid] for aid in unique_buys if aid in cvm.top_20_buy2buy]))
-
-            for aid in aids3: aids_temp[aid] += 0.1  # 为这些aid增加额外的权重
-            sorted_aids = [k for k, v in aids_temp.most_common(20)]  # 获取得分最高的20个aid
-            return sorted_aids
-
-        # 从buys共现矩阵中获取与unique_aids相关的aid，并展平列表
-        aids2 = list(itertools.chain(*[cvm.top_20_buys[aid] for aid in unique_aids if aid in cvm.top_20_buys]))
-        # 从buy2buy共现矩阵中获取与unique_buys相关的aid，并展平列表
-        aids3 = list(itertools.chain(*[cvm.top_20_buy2buy[aid] for aid in unique_buys if aid in cvm.top_20_buy2buy]))
+            multipliers = np.array([self.type_weight_multipliers[t] for t in types])
+            base = (aids, (weights * multipliers).tolist())
+            return self.buy_scorer.top(matrices, self.buy_scorer.boost, queries, 20, base)
 
-        # 计数并排序，排除已在unique_aids中的aid
-        top_aids2 = [aid2 for aid2, cnt in Counter(aids2 + aids3).most_common(20) if aid2 not in unique_aids]
+        # 合并各来源（原规则为buys与buy2buy共现矩阵）的邻居，按得分排序，排除已在unique_aids中的aid
+        top_aids2 = [aid2 for aid2 in self.buy_scorer.top(matrices, self.buy_scorer.sources, queries, 20)
+                     if aid2 not in unique_aids]
 
         result = unique_aids + top_aids2[:20 - len(unique_aids)]  # 合并列表，确保结果长度为20
         return result + list(cvm.top_orders)[:20 - len(result)]  # 如果结果不足20，用测试期间的点击补充
 
-    def train(self, cvm: CoVisitationMatrix):
-        self.pred_df_clicks = cvm.test_df.sort_values(["session", "ts"]).groupby(["session"]).apply(
-            lambda x: self.suggest_clicks(x, cvm)
-        )
-
-        self.pred_df_buys = cvm.test_df.sort_values(["session", "ts"]).groupby(["session"]).apply(
-            lambda x: self.suggest_buys(x, cvm)
-        )
-
-    def save(self):
-        clicks_pred_df = pd.DataFrame(self.pred_df_clicks.add_suffix("_clicks"), columns=["labels"]).reset_index()
-        orders_pred_df = pd.DataFrame(self.pred_df_buys.add_suffix("_orders"), columns=["labels"]).reset_index()
-        carts_pred_df = pd.DataFrame(self.pred_df_buys.add_suffix("_carts"), columns=["labels"]).reset_index()
-        pred_df = pd.concat([clicks_pred_df, orders_pred_df, carts_pred_df])
-        pred_df.columns = ["session_type", "labels"]
-        pred_df["labels"] = pred_df.labels.apply(lambda x: " ".join(map(str, x)))
-        pred_df.to_csv("submission.csv", index=False)
-        print("Saved submission to submission.csv\n", pred_df.head())
+    # 对一段测试数据执行规则，返回 (clicks预测, buys预测)，均为以session为索引的Series
+    # 开启统计时记录 rules 阶段的行数，逐session执行时还记录每个session的耗时分布（毫秒）
+    def _score(self, test_df, cvm: CoVisitationMatrix, batch=None):
+        with profiler.stage('rules') as stage:
+            stage.rows_in = len(test_df)
+            if batch is not None:
+                pred_clicks, pred_buys = batch.suggest_clicks(test_df), batch.suggest_buys(test_df)
+            else:
+                pred_clicks = test_df.sort_values(["session", "ts"]).groupby(["session"]).apply(
+                    lambda x: profiler.timed('session_clicks_ms', self.suggest_clicks, x, cvm)
+                )
+
+                pred_buys = test_df.sort_values(["session", "ts"]).groupby(["session"]).apply(
+                    lambda x: profiler.timed('session_buys_ms', self.suggest_buys, x, cvm)
+                )
+            stage.rows_out = len(pred_clicks)
+        return pred_clicks, pred_buys
+
+    # engine='batch' 时所有session一次性向量化计算（见batch_rules.py），结果与逐session执行规则相同；
+    # engine='apply' 时按session逐个调用 suggest_clicks / suggest_buys
+    # workers>1 时按session范围把测试数据分片，交给fork出的进程池并行计算，再按session顺序拼接；
+    # 共现矩阵通过fork继承（CSR矩阵为内存映射，共享页缓存），不需要序列化传给工作进程
+    @staged
+    def train(self, cvm: CoVisitationMatrix, engine='batch', workers=1):
+        global _WORKER_STATE
+        batch = BatchRules(cvm, self.type_weight_multipliers, self.buy_scorer) if engine == 'batch' else None
+        if workers <= 1:
+            self.pred_df_clicks, self.pred_df_buys = self._score(cvm.test_df, cvm, batch)
+            return
+
+        test_df = cvm.test_df.sort_values(["session", "ts"]).reset_index(drop=True)
+        sessions = test_df.session.values
+        # 每个工作进程分到多个分片，平衡不同分片之间session长度的差异
+        shards = np.array_split(np.unique(sessions), workers * 4)
+        bounds = [(np.searchsorted(sessions, shard[0], side='left'), np.searchsorted(sessions, shard[-1], side='right'))
+                  for shard in shards if len(shard)]
+
+        _WORKER_STATE = (self, test_df, cvm, batch)
+        try:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = []
+                for result, stats in pool.map(_score_shard, bounds):
+                    profiler.merge(stats)
+                    results.append(result)
+        finally:
+            _WORKER_STATE = None
+        self.pred_df_clicks = pd.concat([clicks for clicks, buys in results])
+        self.pred_df_buys = pd.concat([buys for clicks, buys in results])
+
+    # 以定长数组保存预测（见submission.py），path 为CSV路径，array_path 不为空时另存为 npy目录 或 .parquet，
+    # 可供 show_pred 按session直接查找；CSV按块流式写出，内容与逐行拼接字符串的写法相同（session升序）
+    @staged
+    def save(self, path="submission.csv", array_path=None):
+        sessions, labels = to_array(self.pred_df_clicks, self.pred_df_buys)
+        if array_path is not None:
+            save_array(array_path, sessions, labels)
+        write_csv(path, sessions, labels)
+        with open(path) as f:
+            head = "".join(itertools.islice(f, 6))
+        print(f"Saved submission to {path}\n", head)
@@ -0,0 +1,143 @@
+import json, os
+import numpy as np, pandas as pd
+
+from src.co_visitation_matrix import CoVisitationMatrix
+from src.piece_accumulator import TreeAccumulator
+from src.top_k import top_k_per_group
+
+'''
+共现矩阵的增量更新：保存未截断（或按keep宽松截断）的商品对累计权重，新的事件文件到来时只计算新文件的贡献，
+合并到对应的aid_x分片中，并且只对发生变化的分片重新计算前K个邻居
+注意：每个新文件独立做session内联，跨越新旧文件的同一session不会产生新旧事件之间的商品对
+'''
+
+
+class IncrementalCoVisitation:
+    '''
+     state_dir下保存：
+        {矩阵名}/piece_{分片号}.pqt   累计权重 (aid_x, aid_y, wgt)
+        manifest.json               已合并的文件、分片数、衰减系数
+     累计权重按 “存储值 × scale / piece_scale” 解释：衰减时只更新全局scale，未变化的分片不需要重写累计权重；
+     前K个结果与累计权重同时写入，尺度相同，未变化分片的输出也不重写，导出CSR时再换算到当前尺度
+    '''
+
+    def __init__(self, cvm: CoVisitationMatrix, state_dir=None, keep=None):
+        self.cvm = cvm
+        self.fm = cvm.fm
+        self.state_dir = state_dir or f'{cvm.output_dir}/incremental'
+        self.keep = keep  # 每个aid_x最多保留的累计邻居数，None表示不截断
+        self.pieces = {spec.name: spec.pieces for spec in cvm.specs}
+        self.top_k = {spec.name: spec.top_k for spec in cvm.specs}
+        self.manifest = self._load_manifest()
+
+    def _manifest_path(self):
+        return f'{self.state_dir}/manifest.json'
+
+    def _load_manifest(self):
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path()) as f:
+                manifest = json.load(f)
+            if manifest['pieces'] != self.pieces:
+                raise ValueError(f'分片数与已有的增量状态不一致：{manifest["pieces"]} != {self.pieces}')
+            return manifest
+        return {'pieces': self.pieces, 'files': {}, 'scale': {name: 1.0 for name in self.pieces},
+                'piece_scale': {name: {} for name in self.pieces}}
+
+    def _save_manifest(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp = f'{self._manifest_path()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self._manifest_path())
+
+    def _piece_path(self, name, piece):
+        return f'{self.state_dir}/{name}/piece_{piece}.pqt'
+
+    @staticmethod
+    def _fingerprint(filename):
+        stat = os.stat(filename)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    # 尚未合并的文件；已合并的文件内容发生变化时无法增量撤销其贡献，需要全量重建
+    def new_files(self, files=None):
+        files = self.fm.files if files is None else files
+        changed = [f for f in files if f in self.manifest['files'] and self.manifest['files'][f] != self._fingerprint(f)]
+        if changed:
+            raise ValueError(f'已合并的文件发生了变化，需要删除 {self.state_dir} 后全量重建：{changed[:3]}')
+        return [f for f in files if f not in self.manifest['files']]
+
+    # 读取一个分片的累计权重（已换算为当前尺度），不存在时返回None；与新数据的权重一样位于计算引擎上（cudf或pandas）
+    def _read_piece(self, name, piece):
+        path = self._piece_path(name, piece)
+        if not os.path.exists(path):
+            return None
+        df = self.cvm.engine.xd.read_parquet(path)
+        factor = self.manifest['scale'][name] / self.manifest['piece_scale'][name][str(piece)]
+        if factor != 1.0:
+            df['wgt'] = (df.wgt * factor).astype('float32')
+        return df.set_index(['aid_x', 'aid_y']).wgt
+
+    # 按keep截断在主机上用numpy完成，cudf的结果先转换为pandas
+    def _write_piece(self, name, piece, tmp):
+        df = self.cvm.engine.to_pandas(tmp.reset_index())
+        if self.keep is not None:
+            df = df.iloc[np.argsort(df.aid_x.values, kind='stable')]
+            df = df.iloc[np.sort(top_k_per_group(df.aid_x.values, df.wgt.values, self.keep))]
+        os.makedirs(f'{self.state_dir}/{name}', exist_ok=True)
+        df.reset_index(drop=True).to_parquet(self._piece_path(name, piece))
+        self.manifest['piece_scale'][name][str(piece)] = self.manifest['scale'][name]
+
+    # 衰减：旧的累计权重整体乘以factor后再合并新数据；只记录在全局scale中，
+    # 整体缩放不改变未变化分片的邻居排序，这些分片的累计权重与输出都不重写
+    def _decay(self, factor):
+        for name in self.pieces:
+            self.manifest['scale'][name] *= factor
+
+    # 各分片已输出的前K个结果换算到当前尺度的系数；不是由增量更新写入的分片（没有记录尺度）不缩放
+    def _output_scales(self):
+        scales = {}
+        for name, pieces in self.pieces.items():
+            scale, piece_scale = self.manifest['scale'][name], self.manifest['piece_scale'][name]
+            scales[name] = [scale / piece_scale[str(p)] if str(p) in piece_scale else 1.0 for p in range(pieces)]
+        return scales
+
+    # 合并新文件：decay为旧权重的衰减系数（如0.9），None表示不衰减；返回各矩阵发生变化的分片
+    def update(self, files=None, decay=None):
+        files = self.new_files(files)
+        if not files:
+            print('No new files to merge.')
+            return {name: [] for name in self.pieces}
+        print(f'Merging {len(files)} new files in groups of {self.fm.READ_CT}...')
+
+        acc = {name: TreeAccumulator() for name in self.pieces}
+        for k in range(0, len(files), self.fm.READ_CT):
+            self.fm.prefetch(files[k + self.fm.READ_CT:k + 2 * self.fm.READ_CT])
+            for name, parts in self.cvm._group_weights(files[k:k + self.fm.READ_CT], self.cvm.specs).items():
+                acc[name].add({piece: part for piece, part in parts.items() if len(part)})
+            print(k, ', ', end='')
+        print()
+
+        changed = {name: acc[name].pieces() for name in self.pieces}
+        if decay is not None:
+            self._decay(decay)
+        for name, top_k in self.top_k.items():
+            for piece in changed[name]:
+                tmp = acc[name].pop(piece)
+                old = self._read_piece(name, piece)
+                tmp = tmp if old is None else old.add(tmp, fill_value=0)
+                self._write_piece(name, piece, tmp)
+                self.cvm._save_top(tmp, top_k, name, piece)
+
+        # 从未出现过商品对的分片也需要输出（空）结果文件，保证load_metrix可以读取全部分片
+        for name, top_k in self.top_k.items():
+            for piece in range(self.pieces[name]):
+                path = f'{self.cvm.output_dir}/top_{top_k}_{name}_{piece}.pqt'
+                if not os.path.exists(path):
+                    pd.DataFrame({'aid_x': pd.Series(dtype='int32'), 'aid_y': pd.Series(dtype='int32'),
+                                  'wgt': pd.Series(dtype='float32')}).to_parquet(path)
+
+        for f in files: self.manifest['files'][f] = self._fingerprint(f)
+        self._save_manifest()
+        self.cvm.export_csr(scales=self._output_scales())
+        print('Changed pieces:', {name: len(p) for name, p in changed.items()})
+        return changed
@@ -0,0 +1,103 @@
+'''
+共现矩阵的声明式定义：每种矩阵由事件过滤、时间窗口、权重、保留的邻居数和分片数描述，
+CoVisitationMatrix 中的执行器对任意一组定义只扫描一次数据，过滤条件和窗口相同的矩阵共用同一次商品对生成
+'''
+
+N_AIDS = 1.86e6  # 商品id的上限，按aid_x分片时每片的范围为 N_AIDS / pieces
+TS_BEGIN = 1659304800  # 训练集开始时间（秒）
+TS_END = 1662328791  # 训练集结束时间（秒）
+DAY = 24 * 60 * 60
+
+
+# 按y端事件的类型分配权重
+def type_weight(weights):
+    return lambda pairs: pairs.type_y.map(weights)
+
+
+# 按x端事件的时间线性增加：训练集开始时为low，结束时为high
+def time_weight(low=1, high=4, begin=TS_BEGIN, end=TS_END):
+    return lambda pairs: low + (high - low) * (pairs.ts_x - begin) / (end - begin)
+
+
+# 按x端事件的时间指数衰减：距离end每过half_life秒权重减半
+def time_decay(half_life, end=TS_END):
+    return lambda pairs: 0.5 ** ((end - pairs.ts_x) / half_life)
+
+
+def constant(value=1):
+    return lambda pairs: value
+
+
+class MatrixSpec:
+    '''
+     name         矩阵名，输出文件为 {output_dir}/top_{top_k}_{name}_{分片号}.pqt
+     weight       weight(pairs) 返回每个商品对的权重，pairs 的列为 aid_x, aid_y, ts_x, ts_y, type_x, type_y
+     top_k        每个aid_x保留的邻居数
+     pieces       按aid_x划分的分片数
+     window       商品对的时间差上限（秒，不含）
+     types        参与计算的事件类型，None表示全部
+     last_n       每个session只取最近的last_n条事件
+     pair_filter  pair_filter(pairs) 返回需要保留的商品对，在按 (session, aid_x, aid_y) 去重之前生效
+     attr         load_metrix 加载到 CoVisitationMatrix 上的属性名，默认与输出文件前缀相同
+     version      weight / pair_filter 的版本号；指定后运行清单用它代替函数内容判断定义是否变化，
+                  用于无法稳定计算签名的函数（例如闭包中引用了带状态的对象），修改函数时需同时修改版本号
+    '''
+
+    def __init__(self, name, weight, top_k, pieces, window=DAY, types=None, last_n=30, pair_filter=None, attr=None,
+                 version=None):
+        self.name = name
+        self.weight = weight
+        self.top_k = top_k
+        self.pieces = pieces
+        self.window = window
+        self.types = None if types is None else tuple(sorted(types))
+        self.last_n = last_n
+        self.pair_filter = pair_filter
+        self.attr = attr or self.prefix
+        self.version = version
+
+    @property
+    def prefix(self):
+        return f'top_{self.top_k}_{self.name}'
+
+    # 过滤与截断相同的矩阵共用同一份事件
+    @property
+    def scan_key(self):
+        return self.types, self.last_n
+
+    # 在此基础上窗口和商品对过滤也相同的矩阵共用同一份商品对
+    @property
+    def pair_key(self):
+        return self.scan_key + (self.window, self.pair_filter)
+
+    def with_pieces(self, pieces):
+        return self.replace(pieces=pieces)
+
+    # 复制一份定义并修改部分参数（例如调节分片数、保留的邻居数、时间窗口），加载时的属性名不变
+    def replace(self, **changes):
+        params = dict(name=self.name, weight=self.weight, top_k=self.top_k, pieces=self.pieces, window=self.window,
+                      types=self.types, last_n=self.last_n, pair_filter=self.pair_filter, attr=self.attr,
+                      version=self.version)
+        # 换了函数而没有给出新的版本号时，不再沿用原来的版本号
+        if ('weight' in changes or 'pair_filter' in changes) and 'version' not in changes:
+            params['version'] = None
+        params.update(changes)
+        return MatrixSpec(**params)
+
+    def __repr__(self):
+        return (f'MatrixSpec({self.name!r}, top_k={self.top_k}, pieces={self.pieces}, window={self.window}, '
+                f'types={self.types}, last_n={self.last_n})')
+
+
+# 原有的三种矩阵
+CARTS_ORDERS = MatrixSpec('carts_orders', type_weight({0: 1, 1: 6, 2: 3}), top_k=15, pieces=20, attr='top_20_buys')
+BUY2BUY = MatrixSpec('buy2buy', constant(1), top_k=15, pieces=4, window=14 * DAY, types=(1, 2),
+                     attr='top_20_buy2buy')
+CLICKS = MatrixSpec('clicks', time_weight(1, 4), top_k=20, pieces=20)
+
+DEFAULT_SPECS = (CARTS_ORDERS, BUY2BUY, CLICKS)
+
+# 可选的矩阵示例：加购物车之后的购买、按时间衰减的购买共现
+CART_TO_ORDER = MatrixSpec('cart2order', constant(1), top_k=15, pieces=4, window=14 * DAY, types=(1, 2),
+                           pair_filter=lambda pairs: (pairs.type_x == 1) & (pairs.type_y == 2) & (pairs.ts_y >= pairs.ts_x))
+BUYS_DECAYED = MatrixSpec('buys_decayed', time_decay(7 * DAY), top_k=15, pieces=4, window=14 * DAY, types=(1, 2))
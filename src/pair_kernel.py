@@ -0,0 +1,68 @@
+import numpy as np, pandas as pd
+
+from src.top_k import group_bounds
+
+'''
+session内商品对的生成：代替 df.merge(df, on='session') 之后再按时间窗口过滤的做法，
+直接根据每个session的偏移量和时间窗口算出每条事件在窗口内的另一端范围，只生成窗口内的商品对，
+并在生成时按 (session, aid_x, aid_y) 去重，避免内联产生的每个session最多30×30行的中间表
+（没有使用numba：窗口范围由searchsorted一次求出，展开与去重都是整列的numpy/pandas操作）
+'''
+
+# ts取反后放在低32位：ts为int32非负数，C - ts 落在 (0, 2^31]
+_C = 1 << 31
+
+
+def _sort_key(session, ts):
+    return (session.astype('int64') << 32) | (_C - ts.astype('int64'))
+
+
+class PairColumns:
+    '''
+     按行号 (x, y) 从事件表中取出商品对两端的列，列名与 merge(on='session') 的结果相同（如 ts_x、type_y），
+     只在访问时生成对应的列
+    '''
+
+    def __init__(self, df, x, y):
+        self.df, self.x, self.y = df, x, y
+
+    def __getattr__(self, col):
+        name, side = col[:-2], col[-2:]
+        if side not in ('_x', '_y') or name not in self.df:
+            raise AttributeError(col)
+        return self.df[name].values[self.x if side == '_x' else self.y]
+
+    __getitem__ = __getattr__
+
+
+def window_pairs(session, aid, ts, window, pair_mask=None):
+    '''
+     输入按 session 升序、ts 降序排列（session内连续），返回 (x, y) 两个行号数组：
+     同一session内 |ts_x - ts_y| < window 且 aid_x != aid_y 的所有商品对，(session, aid_x, aid_y) 相同时只保留第一对；
+     pair_mask(x, y) 返回额外需要保留的商品对，在去重之前生效；
+     顺序与 merge(on='session') 的结果一致（session内按x的先后、再按y的先后），因此保留下来的正是 drop_duplicates 的第一条
+    '''
+    n = len(session)
+    if n == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+    key = _sort_key(session, ts)
+    high = session.astype('int64') << 32
+    # session内ts降序：与x时间差小于window的y是连续的一段 [lo, hi)
+    lo = np.searchsorted(key, high | np.clip(_C - ts.astype('int64') - window + 1, 0, None), 'left')
+    hi = np.searchsorted(key, high | np.clip(_C - ts.astype('int64') + window, None, (1 << 32) - 1), 'left')
+    counts = hi - lo
+
+    x = np.repeat(np.arange(n), counts)
+    y = np.arange(len(x)) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+    keep = aid[x] != aid[y]
+    if pair_mask is not None:
+        keep &= np.asarray(pair_mask(x, y), dtype=bool)
+    x, y = x[keep], y[keep]
+
+    # (session, aid) 按首次出现的顺序编号，同一session内的编号连续，y端只需要session内的相对编号
+    codes, _ = pd.factorize(high | aid.astype('int64'))
+    starts, sizes = group_bounds(session)
+    local = codes - np.repeat(codes[starts], sizes)
+    width = int(local.max()) + 1
+    dup = pd.Series(codes[x].astype('int64') * width + local[y]).duplicated().values
+    return x[~dup], y[~dup]
@@ -0,0 +1,121 @@
+import glob, os, shutil
+
+'''
+按aid_x分片的累加器，用于单次扫描构建共现矩阵时汇总每组文件的商品对权重
+累加方式与逐片计算时一致：先在CHUNK内用 add(fill_value=0) 累加，CHUNK结束后再汇总，保证浮点累加顺序相同
+'''
+
+
+class PieceAccumulator:
+    '''
+     内存累加器：所有分片的累加结果都保存在内存（或显存）中
+    '''
+
+    def __init__(self):
+        self.done = {}  # 已完成的CHUNK汇总结果（key：分片号，val：以(aid_x, aid_y)为索引的权重Series）
+        self.chunk = {}  # 当前CHUNK内的累加结果
+
+    def add(self, parts):
+        for piece, part in parts.items():
+            self.chunk[piece] = part if piece not in self.chunk else self.chunk[piece].add(part, fill_value=0)
+
+    def end_chunk(self):
+        for piece, part in self.chunk.items():
+            self.done[piece] = part if piece not in self.done else self.done[piece].add(part, fill_value=0)
+        self.chunk = {}
+
+    def pieces(self):
+        return sorted(self.done)
+
+    def pop(self, piece):
+        return self.done.pop(piece)
+
+
+class SpillAccumulator:
+    '''
+     溢写累加器：每组文件的分片结果直接写入磁盘 {spill_dir}/piece_{分片号}/chunk_{CHUNK号}_run_{序号}.pqt，
+     最后逐个分片读回并归约，内存占用只与单个分片的大小有关，与分片数、文件数无关
+     空的分片结果不写入磁盘，只保留一个空的结果，没有任何数据的分片归约后返回它
+    '''
+
+    def __init__(self, spill_dir, engine):
+        self.spill_dir = spill_dir
+        self.engine = engine
+        self.chunk_no = 0
+        self.run_no = 0
+        self.empty = {}  # 出现过但还没有写入数据的分片（key：分片号，val：空的权重Series）
+        if os.path.exists(spill_dir): shutil.rmtree(spill_dir)
+        os.makedirs(spill_dir)
+
+    def _piece_dir(self, piece):
+        return f'{self.spill_dir}/piece_{piece}'
+
+    def add(self, parts):
+        for piece, part in parts.items():
+            if not len(part):
+                if not os.path.exists(self._piece_dir(piece)): self.empty.setdefault(piece, part)
+                continue
+            self.empty.pop(piece, None)
+            os.makedirs(self._piece_dir(piece), exist_ok=True)
+            path = f'{self._piece_dir(piece)}/chunk_{self.chunk_no:03d}_run_{self.run_no:05d}.pqt'
+            self.engine.to_pandas(part.reset_index()).to_parquet(path)
+        self.run_no += 1
+
+    def end_chunk(self):
+        self.chunk_no += 1
+
+    def pieces(self):
+        return sorted([int(d.rsplit('_', 1)[1]) for d in os.listdir(self.spill_dir)] + list(self.empty))
+
+    def _read_run(self, path):
+        return self.engine.xd.read_parquet(path).set_index(['aid_x', 'aid_y']).wgt
+
+    # 读回一个分片的全部溢写文件，按写入顺序归约（先CHUNK内、再CHUNK间），归约后删除溢写文件
+    def pop(self, piece):
+        if piece in self.empty:
+            return self.empty.pop(piece)
+        runs = sorted(glob.glob(f'{self._piece_dir(piece)}/*.pqt'))
+        tmp, tmp2, chunk = None, None, None
+        for run in runs:
+            run_chunk = os.path.basename(run).split('_')[1]
+            part = self._read_run(run)
+            if run_chunk != chunk:
+                if tmp2 is not None: tmp = tmp2 if tmp is None else tmp.add(tmp2, fill_value=0)
+                tmp2, chunk = part, run_chunk
+            else:
+                tmp2 = tmp2.add(part, fill_value=0)
+        if tmp2 is not None: tmp = tmp2 if tmp is None else tmp.add(tmp2, fill_value=0)
+        shutil.rmtree(self._piece_dir(piece))
+        return tmp
+
+
+class TreeAccumulator:
+    '''
+     树形累加器：每个分片维护一个按层级排列的部分和栈，新结果到达时与同层级的部分和两两合并（类似二进制计数器），
+     每份数据只参与 O(log n) 次合并，避免逐个 add 时累加结果不断增长、反复重新分配带来的平方级开销
+    '''
+
+    def __init__(self):
+        self.stacks = {}  # key：分片号，val：[(层级, 部分和), ...]
+
+    def add(self, parts):
+        for piece, part in parts.items():
+            stack = self.stacks.setdefault(piece, [])
+            level = 0
+            while stack and stack[-1][0] == level:
+                part = stack.pop()[1].add(part, fill_value=0)
+                level += 1
+            stack.append((level, part))
+
+    def end_chunk(self):
+        pass
+
+    def pieces(self):
+        return sorted(self.stacks)
+
+    def pop(self, piece):
+        stack = self.stacks.pop(piece)
+        tmp = stack.pop()[1]
+        while stack:
+            tmp = stack.pop()[1].add(tmp, fill_value=0)
+        return tmp
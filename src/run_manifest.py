@@ -0,0 +1,88 @@
+import functools, hashlib, json, os, re, time, types
+import numpy as np
+
+'''
+共现矩阵训练的运行清单：每完成一个 (矩阵, 分片) 的输出就写入一个标记文件 {directory}/{矩阵名}_{分片号}.json，
+记录输入文件的指纹与矩阵定义的签名；重新运行时跳过标记有效（指纹与签名一致、输出文件存在）的分片
+每个分片单独一个标记文件，多台机器或多个进程分别计算不同分片时不会相互覆盖
+'''
+
+
+# 输入文件的指纹：路径、大小与修改时间
+def fingerprint_files(files):
+    stats = []
+    for f in sorted(files):
+        stat = os.stat(f)
+        stats.append([f, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+
+# 值的签名：函数为字节码、常量、引用的名字与闭包中的值，嵌套的函数、代码对象、functools.partial、
+# 被装饰函数（__wrapped__）与容器逐层展开，不使用含内存地址的repr，同一个定义在不同进程中的签名相同
+def _signature(value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 'recursive'
+    if isinstance(value, (type(None), bool, int, float, complex, str, bytes)):
+        return repr(value)
+    seen = seen | {id(value)}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_signature(v, seen) for v in value]
+        return f'{type(value).__name__}({sorted(items) if isinstance(value, (set, frozenset)) else items})'
+    if isinstance(value, dict):
+        return f'dict({sorted((_signature(k, seen), _signature(v, seen)) for k, v in value.items())})'
+    if isinstance(value, types.CodeType):
+        return f'code({value.co_code.hex()}, {_signature(value.co_consts, seen)}, {value.co_names})'
+    if isinstance(value, functools.partial):
+        return f'partial({_signature(value.func, seen)}, {_signature(value.args, seen)}, {_signature(value.keywords, seen)})'
+    if hasattr(value, '__wrapped__'):
+        return f'wrapped({_signature(value.__wrapped__, seen)})'
+    if isinstance(value, types.FunctionType):
+        cells = [c.cell_contents for c in value.__closure__ or ()]
+        return f'function({_signature(value.__code__, seen)}, {_signature(cells, seen)}, {_signature(value.__defaults__, seen)})'
+    if isinstance(value, (type, types.BuiltinFunctionType, types.ModuleType)):
+        return f'{getattr(value, "__module__", None)}.{getattr(value, "__qualname__", value.__name__)}'
+    if isinstance(value, np.ndarray):
+        return f'ndarray({value.dtype}, {value.shape}, {hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()})'
+    text = repr(value)
+    if re.search(r' at 0x[0-9a-fA-F]+', text):
+        raise ValueError(f'无法稳定计算 {text} 的签名，请为矩阵定义指定 version')
+    return text
+
+
+def spec_signature(spec):
+    if spec.version is not None:
+        functions = ['version', spec.version]
+    else:
+        functions = [_sha1(_signature(spec.weight)), _sha1(_signature(spec.pair_filter))]
+    return _sha1(json.dumps([spec.name, spec.top_k, spec.pieces, spec.window, spec.types, spec.last_n] + functions))
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class RunManifest:
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        self.fingerprint = fingerprint
+
+    def _path(self, spec, piece):
+        return f'{self.directory}/{spec.name}_{piece}.json'
+
+    def is_done(self, spec, piece, output):
+        path = self._path(spec, piece)
+        if not os.path.exists(path) or not os.path.exists(output):
+            return False
+        with open(path) as f:
+            record = json.load(f)
+        return record['inputs'] == self.fingerprint and record['spec'] == spec_signature(spec)
+
+    def mark_done(self, spec, piece, output, rows):
+        os.makedirs(self.directory, exist_ok=True)
+        record = {'matrix': spec.name, 'piece': piece, 'output': output, 'rows': rows, 'inputs': self.fingerprint,
+                  'spec': spec_signature(spec), 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+        tmp = f'{self._path(spec, piece)}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f, indent=1)
+        os.replace(tmp, self._path(spec, piece))
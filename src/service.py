@@ -0,0 +1,139 @@
+import argparse, asyncio, json, time
+from collections import deque
+import numpy as np
+
+from src.co_visitation_matrix import CoVisitationMatrix
+from src.file_manager import FileManager
+from src.handcrafted_rules import HandCraftedRules
+from utils.profiler import profiler
+
+'''
+在线推荐服务：对单个session最近的 (aid, ts, type) 事件返回 clicks/carts/orders 各前20个商品
+RecommendationService 可以在进程内直接调用；serve() 提供一个基于asyncio的简易HTTP前端：
+    POST /recommend  {"events": [[aid, ts, type], ...]}  type可以是0/1/2或'clicks'/'carts'/'orders'
+    GET  /stats      最近请求的延迟分位数
+    GET  /health
+运行：python -m src.service --root ./parquet --output-dir ./handled_files --port 8080
+'''
+
+P50_TARGET_MS = 1.0  # 单次请求延迟目标（进程内，不含网络）
+P99_TARGET_MS = 5.0
+MAX_BODY_BYTES = 1 << 20  # 请求体上限（字节），超过时返回400，避免按客户端给出的长度读入任意大的数据
+
+
+class RecommendationService:
+    '''
+     cvm为已加载共现矩阵（load_metrix）的CoVisitationMatrix；规则与离线批量预测相同
+    '''
+
+    def __init__(self, cvm: CoVisitationMatrix, rules: HandCraftedRules = None, window=10000):
+        self.cvm = cvm
+        self.rules = rules or HandCraftedRules()
+        self.type_labels = {'clicks': 0, 'carts': 1, 'orders': 2}
+        self.latencies = deque(maxlen=window)  # 最近window次请求的耗时（秒）
+
+    def recommend(self, events):
+        start = time.perf_counter()
+        # 按时间排序（稳定排序，与离线 sort_values(['session', 'ts']) 一致）
+        events = sorted(events, key=lambda e: e[1])
+        aids = [int(e[0]) for e in events]
+        types = [self.type_labels[e[2]] if isinstance(e[2], str) else int(e[2]) for e in events]
+        if not aids:
+            clicks = list(self.cvm.top_clicks)[:20]
+            buys = list(self.cvm.top_orders)[:20]
+        else:
+            clicks = self.rules.suggest_clicks_list(aids, types, self.cvm)
+            buys = self.rules.suggest_buys_list(aids, types, self.cvm)
+        self.latencies.append(time.perf_counter() - start)
+        profiler.observe('recommend_ms', self.latencies[-1] * 1000)
+        return {'clicks': [int(a) for a in clicks], 'carts': [int(a) for a in buys], 'orders': [int(a) for a in buys]}
+
+    def stats(self):
+        if not self.latencies:
+            return {'requests': 0}
+        ms = np.array(self.latencies) * 1000
+        return {'requests': len(ms), 'p50_ms': float(np.percentile(ms, 50)), 'p99_ms': float(np.percentile(ms, 99)),
+                'max_ms': float(ms.max()), 'p50_target_ms': P50_TARGET_MS, 'p99_target_ms': P99_TARGET_MS}
+
+
+def _response(status, body):
+    body = json.dumps(body).encode()
+    head = f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'
+    return head.encode() + body
+
+
+# 读取请求行与请求头，返回 (method, path, Content-Length)；格式错误时抛出ValueError
+async def _read_head(reader, request_line):
+    method, path, _ = request_line.decode().split(' ', 2)
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    if not 0 <= length <= MAX_BODY_BYTES:
+        raise ValueError(f'Content-Length {length} 超出范围（0 ~ {MAX_BODY_BYTES}）')
+    return method, path, length
+
+
+async def _handle(service, reader, writer):
+    try:
+        # 支持keep-alive：同一连接上循环处理请求，直到客户端关闭
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, length = await _read_head(reader, request_line)
+            except ValueError as e:
+                # 请求格式错误时无法确定下一个请求从哪里开始，返回400后关闭连接
+                writer.write(_response('400 Bad Request', {'error': str(e)}))
+                await writer.drain()
+                break
+            body = await reader.readexactly(length) if length else b''
+
+            if method == 'POST' and path == '/recommend':
+                try:
+                    writer.write(_response('200 OK', service.recommend(json.loads(body)['events'])))
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    writer.write(_response('400 Bad Request', {'error': str(e)}))
+            elif method == 'GET' and path == '/stats':
+                writer.write(_response('200 OK', service.stats()))
+            elif method == 'GET' and path == '/health':
+                writer.write(_response('200 OK', {'status': 'ok'}))
+            else:
+                writer.write(_response('404 Not Found', {'error': f'{method} {path}'}))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(service, host='127.0.0.1', port=8080):
+    return await asyncio.start_server(lambda r, w: _handle(service, r, w), host, port)
+
+
+def serve(service, host='127.0.0.1', port=8080):
+    async def main():
+        server = await start_server(service, host, port)
+        print(f'Serving on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default='./parquet')
+    parser.add_argument('--output-dir', default='./handled_files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    cvm = CoVisitationMatrix(FileManager(args.root, engine='cpu'), output_dir=args.output_dir)
+    cvm.load_metrix()
+    serve(RecommendationService(cvm), args.host, args.port)
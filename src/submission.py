@@ -0,0 +1,100 @@
+import itertools, os
+import numpy as np
+import pyarrow as pa, pyarrow.compute as pc, pyarrow.parquet as pq
+
+'''
+预测结果的输出：
+    定长数组  sessions [n] int32（升序） 与 labels [n, 3, 20] int32（第二维依次为 clicks/carts/orders，不足20个时补-1），
+             保存为目录下的 sessions.npy、labels.npy（可内存映射），或一个parquet文件（session 与三个定长列表列）
+    CSV      与原来的 submission.csv 格式相同（session_type,labels），在Arrow中按块向量化拼接字符串并直接写出
+'''
+
+TARGETS = ('clicks', 'carts', 'orders')
+CSV_ORDER = ('clicks', 'orders', 'carts')  # submission.csv 中各类预测的先后顺序
+WIDTH = 20
+PAD = -1
+
+
+# 以session为索引、值为商品列表的Series转换为 [n, WIDTH] 的定长数组（超过WIDTH的部分截断）
+def pad_labels(pred):
+    lengths = np.fromiter((len(v) for v in pred.values), dtype='int64', count=len(pred))
+    flat = np.fromiter(itertools.chain.from_iterable(pred.values), dtype='int32', count=int(lengths.sum()))
+    col = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    row = np.repeat(np.arange(len(pred)), lengths)
+    keep = col < WIDTH
+    labels = np.full((len(pred), WIDTH), PAD, dtype='int32')
+    labels[row[keep], col[keep]] = flat[keep]
+    return labels
+
+
+# clicks、buys 为 HandCraftedRules 的预测（两者的session相同）；carts与orders都使用buys
+def to_array(pred_clicks, pred_buys):
+    pred_clicks, pred_buys = pred_clicks.sort_index(), pred_buys.sort_index()
+    if not pred_clicks.index.equals(pred_buys.index):
+        raise ValueError('clicks 与 buys 预测的session不一致')
+    sessions = pred_clicks.index.values.astype('int32')
+    clicks, buys = pad_labels(pred_clicks), pad_labels(pred_buys)
+    return sessions, np.stack([clicks, buys, buys], axis=1)
+
+
+def save_array(path, sessions, labels):
+    if path.endswith('.parquet'):
+        columns = {'session': pa.array(sessions)}
+        for i, target in enumerate(TARGETS):
+            columns[target] = pa.FixedSizeListArray.from_arrays(pa.array(labels[:, i].ravel()), WIDTH)
+        pq.write_table(pa.table(columns), path)
+    else:
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/sessions.npy', sessions)
+        np.save(f'{path}/labels.npy', labels)
+
+
+def load_array(path, mmap=True):
+    if path.endswith('.parquet'):
+        table = pq.read_table(path)
+        labels = np.stack([table[t].combine_chunks().flatten().to_numpy().reshape(-1, WIDTH) for t in TARGETS], axis=1)
+        return table['session'].to_numpy(), labels
+    mode = 'r' if mmap else None
+    return np.load(f'{path}/sessions.npy', mmap_mode=mode), np.load(f'{path}/labels.npy', mmap_mode=mode)
+
+
+# 按session直接查找预测：npy格式只读取对应的行，parquet格式只读取包含这些session的行组
+def lookup(path, sessions):
+    sessions = np.asarray(sessions, dtype='int32')
+    if path.endswith('.parquet'):
+        table = pq.read_table(path, filters=[('session', 'in', sessions.tolist())])
+        found = table['session'].to_numpy()
+        rows = {t: table[t].combine_chunks().flatten().to_numpy().reshape(-1, WIDTH) for t in TARGETS}
+        result = {int(s): {t: rows[t][i] for t in TARGETS} for i, s in enumerate(found)}
+    else:
+        all_sessions, labels = load_array(path)
+        pos = np.minimum(np.searchsorted(all_sessions, sessions), len(all_sessions) - 1)
+        pos = pos[all_sessions[pos] == sessions]
+        result = {int(all_sessions[p]): {t: np.asarray(labels[p, i]) for i, t in enumerate(TARGETS)} for p in pos}
+    return {s: {t: v[v != PAD].tolist() for t, v in targets.items()} for s, targets in result.items()}
+
+
+# 一块session的CSV行：在Arrow中把整数转为字符串再按行拼接，不为每个商品创建Python字符串
+def _csv_lines(sessions, labels, target):
+    cols = [pc.if_else(pc.equal(col, PAD), pa.scalar(None, pa.string()), pc.cast(col, pa.string()))
+            for col in (pa.array(labels[:, j]) for j in range(labels.shape[1]))]
+    joined = pc.binary_join_element_wise(*cols, ' ', null_handling='skip')
+    keys = pc.binary_join_element_wise(pc.cast(pa.array(sessions), pa.string()), target, '_')
+    lines = pc.binary_join_element_wise(keys, joined, ',')
+    return pc.binary_join_element_wise(lines, pa.scalar(''), '\n')
+
+
+# StringArray 的数据缓冲区即为各行首尾相接的内容，直接写入文件
+def _write_string_array(f, arr):
+    offsets = np.frombuffer(arr.buffers()[1], dtype='int32')[arr.offset:arr.offset + len(arr) + 1]
+    f.write(memoryview(arr.buffers()[2])[offsets[0]:offsets[-1]])
+
+
+def write_csv(path, sessions, labels, chunk_rows=1_000_000):
+    with open(path, 'wb') as f:
+        f.write(b'session_type,labels\n')
+        for target in CSV_ORDER:
+            i = TARGETS.index(target)
+            for begin in range(0, len(sessions), chunk_rows):
+                end = begin + chunk_rows
+                _write_string_array(f, _csv_lines(sessions[begin:end], np.asarray(labels[begin:end, i]), target))
@@ -0,0 +1,74 @@
+import numpy as np
+
+'''
+按组选取权重最高的K个元素（CSR分组：同一组的行在数组中连续存放）
+不对全部商品对排序：每组只做部分选择（np.partition），再对选出的K个排序
+分组按长度分桶（K以内一桶，超过K的按2的幂分桶），每桶补齐成二维数组后整体向量化处理，补齐的浪费不超过一倍
+'''
+
+MAX_CELLS = 1 << 22
+
+
+def group_bounds(keys):
+    '''
+     keys已按组排列（相同的key连续），返回每组的起始位置和长度
+    '''
+    if len(keys) == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    return starts, counts
+
+
+# 对一个桶内的组（补齐为width列）做选择和排序，返回 (保留的列号[n, m], 是否有效[n, m])
+def _select_bucket(values, starts, counts, width, k):
+    cols = np.arange(width)
+    valid = cols[None, :] < counts[:, None]
+    idx = np.where(valid, starts[:, None] + cols[None, :], 0)
+    vals = np.where(valid, values[idx], -np.inf)
+
+    if width > k:
+        # 第k大的值作为阈值；大于阈值的全部保留，等于阈值的按位置先后补足k个（与稳定排序的结果一致）
+        kth = -np.partition(-vals, k - 1, axis=1)[:, k - 1]
+        gt = vals > kth[:, None]
+        eq = vals == kth[:, None]
+        need = k - gt.sum(axis=1)
+        keep = gt | (eq & (np.cumsum(eq, axis=1) <= need[:, None]))
+        # 每行恰好保留k个，按行展开后即为按位置排列的列号
+        cols = np.nonzero(keep)[1].reshape(-1, k)
+        vals = np.take_along_axis(vals, cols, axis=1)
+        valid = np.ones(cols.shape, dtype=bool)
+    else:
+        cols = np.broadcast_to(cols, vals.shape)
+
+    # 只对选出的（最多k个）元素按权重降序做稳定排序，权重相同时保持原来的先后顺序
+    order = np.argsort(-vals, axis=1, kind='stable')
+    return np.take_along_axis(cols, order, axis=1), np.take_along_axis(valid, order, axis=1)
+
+
+def top_k_per_group(keys, values, k):
+    '''
+     keys为已按组排列的组号（如aid_x），values为权重；返回每组权重最高的k行的下标，
+     结果按组的顺序排列，组内按权重降序，权重相同时按原来的位置先后（与 sort_values 稳定排序 + cumcount < k 的结果一致）
+    '''
+    keys = np.asarray(keys)
+    values = np.asarray(values)
+    starts, counts = group_bounds(keys)
+    kept = np.minimum(counts, k)
+    out_offset = np.cumsum(kept) - kept
+    out = np.empty(int(kept.sum()), dtype='int64')
+    if len(out) == 0:
+        return out
+
+    # 分桶：长度不超过k的组放在宽度为k的桶里，其余按大于等于长度的最小2的幂分桶
+    widths = np.where(counts <= k, k, 1 << np.ceil(np.log2(np.maximum(counts, 1))).astype('int64'))
+    for width in np.unique(widths):
+        bucket = np.flatnonzero(widths == width)
+        # 每批最多处理 MAX_CELLS 个补齐后的元素，控制临时二维数组的内存
+        step = max(1, MAX_CELLS // int(width))
+        for i in range(0, len(bucket), step):
+            seg = bucket[i:i + step]
+            cols, valid = _select_bucket(values, starts[seg], counts[seg], int(width), k)
+            rank = np.broadcast_to(np.arange(cols.shape[1]), cols.shape)
+            out[(out_offset[seg][:, None] + rank)[valid]] = (starts[seg][:, None] + cols)[valid]
+    return out
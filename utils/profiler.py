@@ -0,0 +1,221 @@
+import cProfile, csv, json, os, resource, threading, time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+import numpy as np
+
+'''
+流水线各阶段的统计：耗时、输入输出行数（商品对生成阶段的 rows_out / rows_in 即内联膨胀倍数）、读取字节数、
+阶段结束时的进程内存峰值与显存占用，以及单个session推理耗时的分布；运行结束时导出为JSON或CSV
+默认关闭，关闭时 stage() 返回空的上下文，不产生额外开销：
+
+    from utils.profiler import profiler
+    profiler.enable(profile_stages={'pairs'}, profile_dir='./profile')  # 可选：对指定阶段做cProfile
+    ...
+    profiler.export('./metrics.json')
+'''
+
+# 延迟直方图的分桶边界（毫秒）
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+
+# 当前进程的内存峰值（MB，Linux上ru_maxrss的单位为KB）
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+_cupy = None  # 第一次查询显存时确定是否可用
+
+
+# GPU已使用的显存（MB），没有cupy或没有GPU时返回None
+def device_used_mb():
+    global _cupy
+    if _cupy is None:
+        try:
+            import cupy
+            cupy.cuda.runtime.getDeviceCount()
+            _cupy = cupy
+        except Exception:
+            _cupy = False
+    if not _cupy:
+        return None
+    free, total = _cupy.cuda.runtime.memGetInfo()
+    return (total - free) / 2 ** 20
+
+
+class StageRecord:
+    '''
+     一次阶段调用中由调用方填写的计数：rows_in、rows_out、bytes_read，以及任意其他计数（add）
+    '''
+
+    def __init__(self):
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.counters = {}
+
+    def add(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class Profiler:
+    '''
+     stages：{阶段名: 汇总的统计}，同名阶段的多次调用累加；histograms：{名称: 观测值列表}
+     profile_stages 中的阶段在cProfile下执行，结果保存为 {profile_dir}/{阶段名}.prof；
+     hooks 为 {阶段名: 返回上下文管理器的函数}，可以接入其他采样分析器
+     cProfile同一时间只能有一个处于活动状态，profile_stages中的阶段不能相互嵌套
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self.histograms = {}
+        self.profile_stages, self.profile_dir, self.hooks = set(), None, {}
+        self._profiles = {}
+        self._lock = threading.Lock()  # 后台预读线程中也会记录阶段
+
+    def enable(self, profile_stages=(), profile_dir='./profile', hooks=None):
+        self.enabled = True
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.hooks = dict(hooks or {})
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    def reset(self):
+        with self._lock:
+            self.stages, self.histograms, self._profiles = {}, {}, {}
+
+    @contextmanager
+    def _stage(self, name):
+        record = StageRecord()
+        profile = self._profiles.setdefault(name, cProfile.Profile()) if name in self.profile_stages else None
+        hook = self.hooks[name]() if name in self.hooks else nullcontext()
+        start = time.perf_counter()
+        with hook:
+            if profile is not None: profile.enable()
+            try:
+                yield record
+            finally:
+                if profile is not None: profile.disable()
+        self._add(name, time.perf_counter() - start, record)
+
+    # 记录一个阶段：with profiler.stage('pairs') as s: ...; s.rows_in = n
+    def stage(self, name):
+        return self._stage(name) if self.enabled else nullcontext(StageRecord())
+
+    def _add(self, name, seconds, record):
+        rss, device = peak_rss_mb(), device_used_mb()
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0,
+                                                  'bytes_read': 0, 'peak_rss_mb': 0.0, 'peak_device_mb': None})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['rows_in'] += int(record.rows_in)
+            stage['rows_out'] += int(record.rows_out)
+            stage['bytes_read'] += int(record.bytes_read)
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], rss)
+            if device is not None: stage['peak_device_mb'] = max(stage['peak_device_mb'] or 0.0, device)
+            for key, value in record.counters.items():
+                stage[key] = stage.get(key, 0) + value
+
+    # 记录一个观测值（如单个session的推理耗时，毫秒）
+    def observe(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.histograms.setdefault(name, []).append(value)
+
+    # 调用func并把耗时（毫秒）记入直方图name
+    def timed(self, name, func, *args, **kwargs):
+        if not self.enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.observe(name, (time.perf_counter() - start) * 1000)
+        return result
+
+    # 取出并清空当前统计（fork出的工作进程把自己的统计返回给主进程）
+    def drain(self):
+        if not self.enabled:
+            return None
+        with self._lock:
+            state = {'stages': self.stages, 'histograms': self.histograms}
+            self.stages, self.histograms = {}, {}
+        return state
+
+    # 合并工作进程返回的统计；内存峰值取最大值，其余累加
+    def merge(self, state):
+        if state is None:
+            return
+        with self._lock:
+            for name, other in state['stages'].items():
+                stage = self.stages.setdefault(name, {'peak_rss_mb': 0.0, 'peak_device_mb': None})
+                for key, value in other.items():
+                    if key == 'peak_rss_mb':
+                        stage[key] = max(stage[key], value)
+                    elif key == 'peak_device_mb':
+                        if value is not None: stage[key] = max(stage[key] or 0.0, value)
+                    else:
+                        stage[key] = stage.get(key, 0) + value
+            for name, values in state['histograms'].items():
+                self.histograms.setdefault(name, []).extend(values)
+
+    def summary(self):
+        stages = []
+        for name, stage in self.stages.items():
+            row = {'stage': name, **stage}
+            row['rows_out_per_in'] = stage['rows_out'] / stage['rows_in'] if stage['rows_in'] else None
+            row['rows_out_per_s'] = stage['rows_out'] / stage['seconds'] if stage['seconds'] else None
+            stages.append(row)
+        histograms = {}
+        for name, values in self.histograms.items():
+            v = np.asarray(values, dtype='float64')
+            counts = np.histogram(v, bins=(0,) + BUCKETS_MS + (np.inf,))[0]
+            histograms[name] = {'count': len(v), 'mean': float(v.mean()), 'p50': float(np.percentile(v, 50)),
+                                'p90': float(np.percentile(v, 90)), 'p99': float(np.percentile(v, 99)),
+                                'max': float(v.max()),
+                                'buckets': {f'<={b}': int(c) for b, c in zip(BUCKETS_MS + ('inf',), counts)}}
+        return {'stages': stages, 'histograms': histograms}
+
+    # 导出统计：.json 为一个文件；.csv 时阶段统计写入path，直方图写入 {path去掉后缀}_histograms.csv；
+    # 同时保存各阶段的cProfile结果
+    def export(self, path):
+        summary = self.summary()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=1)
+        else:
+            columns = list(dict.fromkeys(key for row in summary['stages'] for key in row))
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, columns)
+                writer.writeheader()
+                writer.writerows(summary['stages'])
+            with open(f'{os.path.splitext(path)[0]}_histograms.csv', 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['name', 'count', 'mean', 'p50', 'p90', 'p99', 'max'] + [f'<={b}' for b in BUCKETS_MS + ('inf',)])
+                for name, h in summary['histograms'].items():
+                    writer.writerow([name] + [h[k] for k in ('count', 'mean', 'p50', 'p90', 'p99', 'max')]
+                                    + list(h['buckets'].values()))
+        if self._profiles:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, profile in self._profiles.items():
+                profile.dump_stats(f'{self.profile_dir}/{name}.prof')
+        print(f'Metrics saved to {path}')
+        return summary
+
+
+profiler = Profiler()  # 全局实例，各模块直接使用
+
+
+# 把整个函数记为一个阶段（阶段名为函数的限定名，如 CoVisitationMatrix.train）
+def staged(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with profiler.stage(func.__qualname__):
+            return func(*args, **kwargs)
+
+    return wrapper
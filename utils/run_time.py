@@ -1,12 +1,15 @@
 import time
 from functools import wraps
 
+from utils.profiler import profiler
+
 
 def run_time(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         start_time = time.perf_counter()
-        result = func(*args, **kwargs)
+        with profiler.stage(func.__qualname__):  # 开启统计时同时记为一个阶段
+            result = func(*args, **kwargs)
         end_time = time.perf_counter()
         elapsed_time = end_time - start_time
         print(f"执行时间：{elapsed_time} 秒\n")
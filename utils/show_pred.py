@@ -1,6 +1,20 @@
-import pandas as pd, numpy as np
+import pandas as pd, numpy as np, pyarrow.parquet as pq
+
+from src.submission import load_array, lookup
+
+
+# path 为 save(array_path=...) 保存的定长数组（npy目录或.parquet）时按session直接查找，只读取需要的行；
+# 为CSV时读取整个文件；sessions 为空时随机抽取n个session查看
+def show_pred(path = "./submission.csv", sessions = None, n = 10):
+    if not path.endswith(".csv"):
+        if sessions is None:
+            all_sessions = pq.read_table(path, columns=["session"])["session"].to_numpy() \
+                if path.endswith(".parquet") else load_array(path)[0]
+            sessions = np.random.choice(all_sessions, min(n, len(all_sessions)), replace=False)
+        for session, pred in lookup(path, sessions).items():
+            _print_session(session, pred["clicks"], pred["orders"])
+        return
 
-def show_pred(path = "./submission.csv"):
     pred = pd.read_csv(path)
     split_data  = pred["session_type"].str.split("_", expand=True)
     split_data.columns = ["session", "type"]
@@ -9,11 +23,12 @@ def show_pred(path = "./submission.csv"):
     pred["session"] = pred["session"].astype(int)
     pred.sort_values("session", inplace=True)
 
-    # 随机抽取10个人查看
-    session_max = int(pred["session"].max())
-    session_min = int(pred["session"].min())
-    random_index = set(np.random.randint(session_min, session_max, 10))
-    cond_index = ((pred["session"].isin(random_index)) & (pred["type"] != "carts"))
+    # 随机抽取n个人查看
+    if sessions is None:
+        session_max = int(pred["session"].max())
+        session_min = int(pred["session"].min())
+        sessions = set(np.random.randint(session_min, session_max, n))
+    cond_index = ((pred["session"].isin(sessions)) & (pred["type"] != "carts"))
     selected = pred[cond_index]
     selected.reset_index(drop=True, inplace=True)
 
@@ -21,7 +36,11 @@ def show_pred(path = "./submission.csv"):
         row = selected[selected["session"] == session]
         clicks = row[row["type"] == "clicks"]
         orders = row[row["type"] == "orders"]
-        print(f"Session号为{session}的用户：")
-        print(f"    可能点击的商品序列为：{np.array(clicks["labels"])}")
-        print(f"    可能购买的商品序列为：{np.array(orders["labels"])}")
-        print(f"\n")
\ No newline at end of file
+        _print_session(session, np.array(clicks["labels"]), np.array(orders["labels"]))
+
+
+def _print_session(session, clicks, orders):
+    print(f"Session号为{session}的用户：")
+    print(f"    可能点击的商品序列为：{clicks}")
+    print(f"    可能购买的商品序列为：{orders}")
+    print(f"\n")
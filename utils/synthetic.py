@@ -0,0 +1,62 @@
+import os
+import numpy as np, pandas as pd
+
+from src.matrix_spec import N_AIDS
+
+'''
+生成与原始数据（*_parquet/*.parquet）格式一致的合成数据集，用于在没有真实数据时做基准测试
+商品热度服从幂律分布，session长度服从几何分布（length_dist='lognormal' 时为长尾的对数正态分布），与真实数据的倾斜程度接近
+n_aids 个商品的id随机分布在 [0, id_range) 中（默认与真实数据相同的 [0, N_AIDS)），按aid_x分片时每个分片都有数据
+'''
+
+TRAIN_TS_BEGIN = 1659304800  # 训练集时间范围（秒）
+TRAIN_TS_END = 1662328791
+TEST_TS_END = TRAIN_TS_END + 7 * 24 * 60 * 60  # 测试集为训练集之后的一周
+TYPE_NAMES = np.array(['clicks', 'carts', 'orders'])
+TYPE_PROBS = [0.90, 0.08, 0.02]
+
+
+def make_events(n_sessions, n_aids, ts_begin, ts_end, session_offset=0, mean_len=10, zipf_a=1.2, seed=0,
+                length_dist='geometric', id_range=int(N_AIDS)):
+    rng = np.random.default_rng(seed)
+    # 每个session的事件数；对数正态分布的均值同样为mean_len，但少数session非常长（最多500条）
+    if length_dist == 'lognormal':
+        sigma = 1.2
+        lengths = rng.lognormal(np.log(mean_len) - sigma ** 2 / 2, sigma, n_sessions)
+        lengths = np.clip(np.round(lengths), 1, 500).astype('int64')
+    else:
+        lengths = rng.geometric(1 / mean_len, n_sessions).astype('int64')
+    total = int(lengths.sum())
+    session = np.repeat(np.arange(session_offset, session_offset + n_sessions, dtype='int32'), lengths)
+    # 商品id：幂律分布的热度，热度排名映射为 [0, id_range) 中随机选取、随机排列的id，避免热门商品都集中在小id上
+    ranks = (rng.zipf(zipf_a, total) - 1) % n_aids
+    aid = rng.choice(id_range, n_aids, replace=False).astype('int32')[ranks]
+    # 每个session有一个起始时间，session内的事件间隔服从指数分布（秒）
+    start = rng.integers(ts_begin, ts_end, n_sessions)
+    gaps = rng.exponential(600, total).astype('int64')
+    first = np.cumsum(lengths) - lengths
+    gaps[first] = 0
+    offset = np.cumsum(gaps)
+    offset -= np.repeat(offset[first], lengths)
+    ts = np.minimum(np.repeat(start, lengths) + offset, ts_end) * 1000
+    types = TYPE_NAMES[rng.choice(3, total, p=TYPE_PROBS)]
+    return pd.DataFrame({'session': session, 'aid': aid, 'ts': ts.astype('int64'), 'type': types})
+
+
+def write_dataset(root, n_sessions=60_000, n_aids=100_000, n_files=12, test_sessions=6_000, test_files=6, seed=0,
+                  length_dist='geometric', id_range=int(N_AIDS)):
+    '''
+     在root下写入 train_parquet/ 与 test_parquet/ 两个目录，每个文件包含一段连续的session
+    '''
+    for name, n, files, ts_begin, ts_end, offset in (
+            ('train', n_sessions, n_files, TRAIN_TS_BEGIN, TRAIN_TS_END, 0),
+            ('test', test_sessions, test_files, TRAIN_TS_END, TEST_TS_END, n_sessions),
+    ):
+        os.makedirs(f'{root}/{name}_parquet', exist_ok=True)
+        df = make_events(n, n_aids, ts_begin, ts_end, session_offset=offset, seed=seed + (name == 'test'),
+                         length_dist=length_dist, id_range=id_range)
+        bounds = np.linspace(offset, offset + n, files + 1).astype('int64')
+        for i in range(files):
+            part = df.loc[(df.session >= bounds[i]) & (df.session < bounds[i + 1])]
+            part.reset_index(drop=True).to_parquet(f'{root}/{name}_parquet/{i:03d}.parquet')
+    return root